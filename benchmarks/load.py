@@ -0,0 +1,274 @@
+"""Reproducible load benchmark for the ingest and dashboard endpoints.
+
+Two steps:
+
+    # Build a synthetic database: 1M readings from 500 cards spread over 30 days
+    python benchmarks/load.py generate --db /tmp/bench/detections.db --rows 1000000 --cards 500 --days 30
+
+    # Replay ingest traffic while dashboards poll, then print JSON results
+    python benchmarks/load.py run --db /tmp/bench/detections.db --duration 10 \
+        --ingest-workers 4 --poll-workers 4 --output results.json
+
+`run` drives the app in-process through the Flask test client. With
+--url http://127.0.0.1:5000 it targets a running server instead; --db must then
+point at that server's database so the script can pick dates and card ids that
+exist. The JSON report holds the throughput and p50/p95/p99 latency of each
+endpoint, so runs can be compared.
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DAY_MS = 24 * 3600 * 1000
+
+
+def import_app(db_path):
+    """Import test.py so that its DB_NAME points at db_path"""
+    os.chdir(os.path.dirname(os.path.abspath(db_path)))
+    if os.path.basename(db_path) != 'detections.db':
+        raise SystemExit("--db must be a file named detections.db (the app's DB_NAME)")
+    sys.path.insert(0, REPO_DIR)
+    import test as app_module
+    return app_module
+
+
+def synthetic_readings(rows, cards, days, seed):
+    """Yield (card_id, detection, timestamp_ms, datetime_formatted) in time order.
+
+    Every card reports at a fixed interval with a cumulative counter that
+    occasionally resets, like a real trap.
+    """
+    rng = random.Random(seed)
+    steps = max(1, rows // cards)
+    end_ms = int(time.time() * 1000) // DAY_MS * DAY_MS
+    start_ms = end_ms - days * DAY_MS
+    interval = max(1, (end_ms - start_ms) // steps)
+    counters = [0] * (cards + 1)
+    emitted = 0
+    for step in range(steps):
+        timestamp_ms = start_ms + step * interval
+        formatted = datetime.fromtimestamp(timestamp_ms / 1000).strftime('%d/%m/%Y %H:%M:%S')
+        for card_id in range(1, cards + 1):
+            if emitted >= rows:
+                return
+            if rng.random() < 0.001:
+                counters[card_id] = 0
+            counters[card_id] += rng.choice((0, 0, 0, 1, 2))
+            yield card_id, counters[card_id], timestamp_ms + card_id, formatted
+            emitted += 1
+
+
+def generate(args):
+    if os.path.exists(args.db):
+        raise SystemExit(f"{args.db} already exists")
+    os.makedirs(os.path.dirname(os.path.abspath(args.db)), exist_ok=True)
+    app_module = import_app(args.db)
+    if app_module.storage.name != 'sqlite':
+        raise SystemExit("generate writes the detections table directly: use STORAGE_BACKEND=sqlite")
+
+    start = time.perf_counter()
+    conn = sqlite3.connect(app_module.DB_NAME)
+    conn.execute("PRAGMA synchronous=OFF")
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO cards (card_id, site) VALUES (?, ?)",
+                         [(card_id, f"site-{card_id % 20}") for card_id in range(1, args.cards + 1)])
+    batch = []
+    inserted = 0
+    for reading in synthetic_readings(args.rows, args.cards, args.days, args.seed):
+        batch.append(reading)
+        if len(batch) >= 50000:
+            with conn:
+                conn.executemany(app_module.INSERT_DETECTION_SQL, batch)
+            inserted += len(batch)
+            batch = []
+    if batch:
+        with conn:
+            conn.executemany(app_module.INSERT_DETECTION_SQL, batch)
+        inserted += len(batch)
+    conn.close()
+    load_seconds = time.perf_counter() - start
+
+    app_module.rebuild_rollups()
+    # /get_detection is served from latest_state, which the direct inserts above skipped
+    with app_module.db_connection() as conn, conn:
+        app_module.rebuild_latest_state(conn)
+    print(json.dumps({
+        "db": os.path.abspath(args.db),
+        "rows": inserted,
+        "cards": args.cards,
+        "days": args.days,
+        "load_seconds": round(load_seconds, 2),
+        "total_seconds": round(time.perf_counter() - start, 2),
+    }))
+
+
+class TestClientTarget:
+    """Sends requests through the Flask test client of an in-process app"""
+
+    def __init__(self, app_module):
+        self.app = app_module.app
+
+    def session(self):
+        client = self.app.test_client()
+
+        def send(method, path, payload=None):
+            response = client.open(path, method=method, json=payload)
+            response.close()
+            return response.status_code
+        return send
+
+
+class HttpTarget:
+    """Sends requests to a running server over HTTP"""
+
+    def __init__(self, url):
+        import requests
+        self.requests = requests
+        self.url = url.rstrip('/')
+
+    def session(self):
+        http = self.requests.Session()
+
+        def send(method, path, payload=None):
+            return http.request(method, self.url + path, json=payload).status_code
+        return send
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(samples, elapsed):
+    report = {}
+    for name, (latencies, errors) in sorted(samples.items()):
+        ordered = sorted(latencies)
+        report[name] = {
+            "requests": len(ordered),
+            "errors": errors,
+            "throughput_rps": round(len(ordered) / elapsed, 1),
+            "latency_ms": {
+                "p50": round(percentile(ordered, 0.50) * 1000, 3),
+                "p95": round(percentile(ordered, 0.95) * 1000, 3),
+                "p99": round(percentile(ordered, 0.99) * 1000, 3),
+                "max": round(ordered[-1] * 1000, 3),
+            } if ordered else None,
+        }
+    return report
+
+
+def run(args):
+    if not os.path.exists(args.db):
+        raise SystemExit(f"{args.db} does not exist, run 'generate' first")
+    conn = sqlite3.connect(args.db)
+    card_ids = [row[0] for row in conn.execute("SELECT card_id FROM cards")] or [1, 2]
+    last_ms = conn.execute("SELECT MAX(timestamp_ms) FROM detections").fetchone()[0] or int(time.time() * 1000)
+    rows = conn.execute("SELECT COUNT(*) FROM detections").fetchone()[0]
+    conn.close()
+
+    last_day = datetime.fromtimestamp(last_ms / 1000, tz=timezone.utc).strftime('%Y-%m-%d')
+    first_day = datetime.fromtimestamp((last_ms - 7 * DAY_MS) / 1000, tz=timezone.utc).strftime('%Y-%m-%d')
+    polls = [
+        ('GET /get_detection', 'GET', '/get_detection?limit=100'),
+        ('GET /detections_per_hour', 'GET', f'/detections_per_hour?date={last_day}&limit=20'),
+        ('GET /detections_per_day', 'GET', f'/detections_per_day?start_date={first_day}&end_date={last_day}'),
+    ]
+
+    target = HttpTarget(args.url) if args.url else TestClientTarget(import_app(args.db))
+    samples = {name: ([], 0) for name, _, _ in polls}
+    samples['POST /send_detection'] = ([], 0)
+    samples_lock = threading.Lock()
+    deadline = time.monotonic() + args.duration
+    next_timestamp = [last_ms + 1000]
+
+    def record(name, latency, status):
+        with samples_lock:
+            latencies, errors = samples[name]
+            latencies.append(latency)
+            if status >= 400:
+                samples[name] = (latencies, errors + 1)
+
+    def ingest_worker(seed):
+        rng = random.Random(seed)
+        send = target.session()
+        while time.monotonic() < deadline:
+            with samples_lock:
+                next_timestamp[0] += 1
+                timestamp = next_timestamp[0]
+            payload = {"x": rng.choice(card_ids), "y": timestamp, "detection": rng.randint(0, 1000)}
+            start = time.perf_counter()
+            status = send('POST', '/send_detection', payload)
+            record('POST /send_detection', time.perf_counter() - start, status)
+
+    def poll_worker(seed):
+        rng = random.Random(seed)
+        send = target.session()
+        while time.monotonic() < deadline:
+            name, method, path = rng.choice(polls)
+            start = time.perf_counter()
+            status = send(method, path)
+            record(name, time.perf_counter() - start, status)
+
+    workers = [threading.Thread(target=ingest_worker, args=(n,)) for n in range(args.ingest_workers)]
+    workers += [threading.Thread(target=poll_worker, args=(1000 + n,)) for n in range(args.poll_workers)]
+    start = time.monotonic()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.monotonic() - start
+
+    report = {
+        "config": {
+            "target": args.url or "flask-test-client",
+            "duration_s": args.duration,
+            "ingest_workers": args.ingest_workers,
+            "poll_workers": args.poll_workers,
+            "python": sys.version.split()[0],
+            "sqlite": sqlite3.sqlite_version,
+        },
+        "db": {"path": os.path.abspath(args.db), "rows_at_start": rows, "cards": len(card_ids)},
+        "elapsed_s": round(elapsed, 2),
+        "endpoints": summarize(samples, elapsed),
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    gen = commands.add_parser('generate', help='build a synthetic detections database')
+    gen.add_argument('--db', required=True, help='path of the detections.db file to create')
+    gen.add_argument('--rows', type=int, default=100000)
+    gen.add_argument('--cards', type=int, default=100)
+    gen.add_argument('--days', type=int, default=30)
+    gen.add_argument('--seed', type=int, default=42)
+
+    bench = commands.add_parser('run', help='replay ingest and dashboard traffic')
+    bench.add_argument('--db', required=True, help='path of the detections.db file to use')
+    bench.add_argument('--url', help='base URL of a running server (default: in-process test client)')
+    bench.add_argument('--duration', type=float, default=10)
+    bench.add_argument('--ingest-workers', type=int, default=4)
+    bench.add_argument('--poll-workers', type=int, default=4)
+    bench.add_argument('--output', help='also write the JSON report to this file')
+
+    args = parser.parse_args()
+    if args.command == 'generate':
+        generate(args)
+    else:
+        run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+"""Check and time the multi-process mode: shared card state and cross-worker Socket.IO.
+
+The script starts ``python test.py`` with WORKERS=N on a fresh database and connects
+one Socket.IO client to every worker. It then sends readings to the workers in turn,
+--concurrency requests at a time (10 by default with --mode gevent, so greenlets of
+one worker compete for its locks). It reports:
+
+- how many of the deltas each client received, and the broadcast latency from the
+  ingest request to delivery on the other workers;
+- whether every worker returns the same /get_detection body once
+  SHARED_STATE_REFRESH_MS has passed.
+
+Usage:
+    python benchmarks/multi_worker.py --workers 3 --readings 200 --mode threading
+
+Results are printed as JSON. The exit status is 1 when a delta was lost or the
+workers disagree; a request that fails or times out stops the run with an error.
+"""
+import argparse
+import concurrent.futures
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import engineio.payload
+import requests
+import socketio
+
+# Concurrent ingest queues many deltas per long-polling response, and the Python client
+# drops the connection when one response holds more than 16 packets
+engineio.payload.Payload.max_decode_packets = 1000
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'test.py')
+
+
+def wait_ready(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            requests.get(f'{url}/get_detection', timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not start")
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000, 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=3)
+    parser.add_argument('--readings', type=int, default=200)
+    parser.add_argument('--cards', type=int, default=10)
+    parser.add_argument('--mode', default='threading', help='ASYNC_MODE of the workers')
+    parser.add_argument('--port', type=int, default=5070)
+    parser.add_argument('--concurrency', type=int, help='requests in flight (default 10 in gevent mode, else 1)')
+    args = parser.parse_args()
+    if args.concurrency is None:
+        args.concurrency = 10 if args.mode == 'gevent' else 1
+
+    urls = [f'http://127.0.0.1:{args.port + index}' for index in range(args.workers)]
+    env = dict(os.environ, WORKERS=str(args.workers), PORT=str(args.port), HOST='127.0.0.1',
+               ASYNC_MODE=args.mode, FLASK_DEBUG='0')
+    launcher = subprocess.Popen([sys.executable, APP_PATH], cwd=tempfile.mkdtemp(prefix='multi-worker-'),
+                                env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    clients = []
+    try:
+        for url in urls:
+            wait_ready(url)
+
+        sent_at = {}
+        received = [dict() for _ in urls]
+        lock = threading.Lock()
+        for index, url in enumerate(urls):
+            client = socketio.Client()
+
+            def on_delta(deltas, index=index):
+                now = time.perf_counter()
+                with lock:
+                    for delta in deltas:
+                        received[index][delta['seq']] = (delta['card_id'], delta['detection'], now)
+            client.on('detection_delta', on_delta)
+            client.connect(url, transports=['polling'])
+            clients.append(client)
+        time.sleep(0.5)
+
+        local = threading.local()
+
+        def send(n):
+            # One session per sender thread: requests.Session is not thread-safe
+            if not hasattr(local, 'http'):
+                local.http = requests.Session()
+            worker = n % len(urls)
+            payload = {"x": n % args.cards + 1, "y": 1700000000000 + n * 1000, "detection": n}
+            with lock:
+                sent_at[(payload["x"], n)] = (worker, time.perf_counter())
+            local.http.post(f'{urls[worker]}/send_detection', json=payload, timeout=10).raise_for_status()
+
+        with concurrent.futures.ThreadPoolExecutor(args.concurrency) as pool:
+            for future in [pool.submit(send, n) for n in range(args.readings)]:
+                future.result()
+
+        # Let the last deltas and state refreshes arrive
+        time.sleep(1.5)
+        latencies = []
+        per_worker = []
+        for index in range(len(urls)):
+            with lock:
+                deliveries = list(received[index].values())
+            per_worker.append(len(deliveries))
+            for card_id, detection, at in deliveries:
+                origin, start = sent_at[(card_id, detection)]
+                if origin != index:
+                    latencies.append(at - start)
+
+        http = requests.Session()
+        bodies = [http.get(f'{url}/get_detection', timeout=10).json() for url in urls]
+        consistent = all(body == bodies[0] for body in bodies)
+        delivered = all(count == args.readings for count in per_worker)
+        print(json.dumps({
+            "workers": args.workers,
+            "mode": args.mode,
+            "concurrency": args.concurrency,
+            "readings": args.readings,
+            "deltas_received_per_worker": per_worker,
+            "cross_worker_latency_ms": {"p50": percentile(latencies, 0.50), "p95": percentile(latencies, 0.95),
+                                        "p99": percentile(latencies, 0.99)},
+            "get_detection_consistent": consistent,
+        }))
+        if not (consistent and delivered):
+            raise SystemExit(1)
+    finally:
+        for client in clients:
+            client.disconnect()
+        launcher.terminate()
+        launcher.wait(timeout=15)
+
+
+if __name__ == '__main__':
+    main()
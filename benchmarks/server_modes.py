@@ -0,0 +1,196 @@
+"""Compare the threading and gevent server modes under concurrent load.
+
+For each mode the script starts ``test.py`` on a fresh database, opens a number of
+idle Socket.IO long-polling sessions (each one holds an open HTTP request, like a
+dashboard waiting for events), then runs concurrent keep-alive clients that
+alternate POST /send_detection and GET /get_detection for a fixed duration.
+
+Usage:
+    python benchmarks/server_modes.py --modes threading gevent --concurrency 50 \
+        --idle-connections 500 --duration 10
+
+Results are printed as JSON, one object per mode.
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'test.py')
+
+
+async def http_request(reader, writer, host, method, path, body=b'', content_type='application/json'):
+    """Send one HTTP/1.1 request on an open connection; returns (status, body, keep_alive)"""
+    head = (f"{method} {path} HTTP/1.1\r\nHost: {host}\r\nContent-Length: {len(body)}\r\n"
+            f"Content-Type: {content_type}\r\n\r\n")
+    writer.write(head.encode() + body)
+    await writer.drain()
+
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("connection closed")
+    status = int(status_line.split()[1])
+    length = 0
+    chunked = False
+    keep_alive = status_line.startswith(b'HTTP/1.1')
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode().partition(':')
+        name = name.strip().lower()
+        if name == 'content-length':
+            length = int(value)
+        elif name == 'transfer-encoding':
+            chunked = value.strip().lower() == 'chunked'
+        elif name == 'connection':
+            keep_alive = value.strip().lower() == 'keep-alive'
+    if chunked:
+        data = b''
+        while True:
+            size = int((await reader.readline()).strip(), 16)
+            chunk = await reader.readexactly(size + 2)
+            if size == 0:
+                break
+            data += chunk[:-2]
+    else:
+        data = await reader.readexactly(length) if length else b''
+    return status, data, keep_alive
+
+
+async def request_once(host, port, method, path, body=b'', content_type='application/json'):
+    """Send one request on a new connection"""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        return await http_request(reader, writer, host, method, path, body, content_type)
+    finally:
+        writer.close()
+
+
+async def open_idle_session(host, port, results):
+    """Open a Socket.IO polling session and leave a long-poll GET pending on it"""
+    try:
+        # The Werkzeug server closes Socket.IO polling connections after each response
+        status, data, _ = await request_once(host, port, 'GET', '/socket.io/?EIO=4&transport=polling')
+        sid = json.loads(data[1:])['sid']
+        path = f'/socket.io/?EIO=4&transport=polling&sid={sid}'
+        await request_once(host, port, 'POST', path, b'40', 'text/plain')
+        await request_once(host, port, 'GET', path)  # connect ack
+        # This GET blocks server side until the next ping or event
+        reader, writer = await asyncio.open_connection(host, port)
+        writer.write(f"GET {path} HTTP/1.1\r\nHost: {host}\r\n\r\n".encode())
+        await writer.drain()
+        results.append(writer)
+    except Exception:
+        pass
+
+
+async def load_client(host, port, deadline, client_id, latencies, errors):
+    """Alternate an ingest POST and a dashboard GET until the deadline"""
+    reader = writer = None
+    i = 0
+    while time.monotonic() < deadline:
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(host, port)
+            if i % 2 == 0:
+                body = json.dumps({"x": client_id % 100 + 1, "y": time.time() * 1000, "detection": i}).encode()
+                request = ('POST', '/send_detection', body)
+            else:
+                request = ('GET', '/get_detection', b'')
+            start = time.perf_counter()
+            status, _, keep_alive = await http_request(reader, writer, host, *request)
+            latencies.append(time.perf_counter() - start)
+            if status >= 400:
+                errors.append(status)
+            if not keep_alive:
+                writer.close()
+                writer = None
+        except Exception as e:
+            errors.append(type(e).__name__)
+            if writer is not None:
+                writer.close()
+            writer = None
+            await asyncio.sleep(0.05)
+        i += 1
+    if writer is not None:
+        writer.close()
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+async def run_load(host, port, args):
+    idle = []
+    await asyncio.gather(*(open_idle_session(host, port, idle) for _ in range(args.idle_connections)))
+
+    latencies, errors = [], []
+    deadline = time.monotonic() + args.duration
+    start = time.monotonic()
+    await asyncio.gather(*(load_client(host, port, deadline, n, latencies, errors)
+                           for n in range(args.concurrency)))
+    elapsed = time.monotonic() - start
+
+    for writer in idle:
+        writer.close()
+    return {
+        "idle_connections": {"requested": args.idle_connections, "established": len(idle)},
+        "concurrency": args.concurrency,
+        "requests": len(latencies),
+        "errors": len(errors),
+        "rps": round(len(latencies) / elapsed, 1),
+        "latency_ms": {name: round(percentile(latencies, q) * 1000, 2) if latencies else None
+                       for name, q in (("p50", 0.50), ("p95", 0.95), ("p99", 0.99))},
+    }
+
+
+def wait_ready(host, port, timeout=30):
+    import urllib.request
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(f'http://{host}:{port}/get_detection', timeout=1).read()
+            return
+        except Exception:
+            time.sleep(0.2)
+    raise RuntimeError(f"server on port {port} did not start")
+
+
+def bench_mode(mode, args):
+    workdir = tempfile.mkdtemp(prefix=f'bench-{mode}-')
+    env = dict(os.environ, ASYNC_MODE=mode, PORT=str(args.port), HOST=args.host, FLASK_DEBUG='0')
+    server = subprocess.Popen([sys.executable, APP_PATH], cwd=workdir, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_ready(args.host, args.port)
+        result = asyncio.run(run_load(args.host, args.port, args))
+    finally:
+        server.terminate()
+        server.wait(timeout=10)
+    return {"mode": mode, **result}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--modes', nargs='+', default=['threading', 'gevent'])
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--idle-connections', type=int, default=500)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5057)
+    args = parser.parse_args()
+
+    for mode in args.modes:
+        print(json.dumps(bench_mode(mode, args)), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""Compare the sqlite and segments storage backends on the same synthetic readings.
+
+For each backend the script imports ``test.py`` with STORAGE_BACKEND set, in a fresh
+directory. It ingests readings through the batch save path in batches of --batch-size,
+then times range reads and histograms on random cards and days:
+
+- ingest: rows/s through save_detections_batch_to_db (rollups and latest state included);
+- card_day: raw readings of one card over one UTC day;
+- histogram_5m: 5-minute increments of --histogram-cards cards over one day;
+- bytes_per_reading: disk used by the raw readings (table and indexes, or segment files);
+- wide_batch_ok: one batch across --wide-batch-cards new cards is stored in full with the
+  open file limit lowered to 256, so a backend must not hold a file per card. The exit
+  status is 1 when it fails.
+
+Usage:
+    python benchmarks/storage.py --rows 500000 --cards 100 --days 30
+
+Results are printed as JSON, one object per backend.
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DAY_MS = 24 * 3600 * 1000
+
+
+def percentiles(latencies):
+    ordered = sorted(latencies)
+    return {name: round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 3)
+            for name, q in (("p50", 0.50), ("p95", 0.95), ("p99", 0.99))}
+
+
+def raw_bytes(app_module):
+    """Disk used by raw readings in the current backend"""
+    if app_module.storage.name == 'segments':
+        return sum(os.path.getsize(os.path.join(root, name))
+                   for root, _, names in os.walk(app_module.SEGMENT_DIR) for name in names)
+    with app_module.db_connection() as conn:
+        return conn.execute('''
+            SELECT SUM(pgsize) FROM dbstat
+            WHERE name IN ('detections', 'idx_detections_card_ts', 'idx_detections_ts')
+        ''').fetchone()[0]
+
+
+def bench_backend(args):
+    os.chdir(tempfile.mkdtemp(prefix=f'bench-{args.child}-'))
+    os.environ['STORAGE_BACKEND'] = args.child
+    sys.path.insert(0, REPO_DIR)
+    sys.path.insert(0, os.path.join(REPO_DIR, 'benchmarks'))
+    import logging
+    import test as app_module
+    from load import synthetic_readings
+    logging.disable(logging.INFO)
+
+    start = time.perf_counter()
+    batch = []
+    for card_id, detection, timestamp_ms, formatted in synthetic_readings(args.rows, args.cards, args.days, args.seed):
+        batch.append((card_id, detection, timestamp_ms, formatted))
+        if len(batch) >= args.batch_size:
+            app_module.save_detections_batch_to_db(batch)
+            batch = []
+    if batch:
+        app_module.save_detections_batch_to_db(batch)
+    ingest_seconds = time.perf_counter() - start
+
+    with app_module.db_connection() as conn:
+        first_ms, last_ms = conn.execute('''
+            SELECT MIN(day_ms), MAX(day_ms) FROM detections_daily
+        ''').fetchone()
+        rng = random.Random(args.seed)
+        card_day, histogram = [], []
+        for _ in range(args.queries):
+            day_ms = rng.randrange(first_ms, last_ms + 1, DAY_MS)
+            card_id = rng.randint(1, args.cards)
+            start = time.perf_counter()
+            list(app_module.storage.card_readings(conn, card_id, day_ms, day_ms + DAY_MS))
+            card_day.append(time.perf_counter() - start)
+        for _ in range(args.queries):
+            day_ms = rng.randrange(first_ms, last_ms + 1, DAY_MS)
+            card_ids = rng.sample(range(1, args.cards + 1), min(args.histogram_cards, args.cards))
+            start = time.perf_counter()
+            app_module.storage.histogram(day_ms, day_ms + DAY_MS, 300000, card_ids)
+            histogram.append(time.perf_counter() - start)
+        rows = app_module.storage.count(conn)
+    bytes_per_reading = round(raw_bytes(app_module) / max(rows, 1), 1)
+
+    # Fewer descriptors than the batch has cards
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (min(256, hard), hard))
+    wide = [(args.cards + n, 1, last_ms + DAY_MS, 'wide') for n in range(1, args.wide_batch_cards + 1)]
+    flags = app_module.save_detections_batch_to_db(wide)
+    with app_module.db_connection() as conn:
+        wide_batch_ok = flags is not None and all(flags) and app_module.storage.count(conn) == rows + len(wide)
+
+    print(json.dumps({
+        "backend": args.child,
+        "rows": rows,
+        "ingest_rows_per_s": round(rows / ingest_seconds),
+        "card_day_ms": percentiles(card_day),
+        "histogram_5m_ms": percentiles(histogram),
+        "bytes_per_reading": bytes_per_reading,
+        "wide_batch_ok": wide_batch_ok,
+    }))
+    if not wide_batch_ok:
+        raise SystemExit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--backends', nargs='+', default=['sqlite', 'segments'])
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--cards', type=int, default=50)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--histogram-cards', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--wide-batch-cards', type=int, default=2000)
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        bench_backend(args)
+        return
+    # One process per backend: test.py reads STORAGE_BACKEND when it is imported
+    for backend in args.backends:
+        subprocess.run([sys.executable, os.path.abspath(__file__), *sys.argv[1:], '--child', backend], check=True)
+
+
+if __name__ == '__main__':
+    main()
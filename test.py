@@ -1,151 +1,1191 @@
-from flask import Flask, request, jsonify
+import os
+
+# Server mode: 'threading' (default, Werkzeug threads) or 'gevent' (greenlets, for many
+# concurrent clients). gevent must patch the standard library before anything else is
+# imported. Threads stay native so SQLite work can run on a real thread pool.
+ASYNC_MODE = os.environ.get('ASYNC_MODE', 'threading')
+if ASYNC_MODE == 'gevent':
+    from gevent import monkey
+    monkey.patch_all(thread=False)
+
+from flask import Flask, Response, g, request, jsonify
 from flask_cors import CORS
-from flask_socketio import SocketIO, emit
+from flask_socketio import SocketIO, join_room, leave_room, rooms
+import array
+import atexit
+import signal
+import socketio as python_socketio
+import struct
+import subprocess
+import sys
+import bisect
+import click
+import csv
+import functools
+import io
+import json
 import logging
+import mmap
+import queue
+import random
+import re
+import shutil
 import sqlite3
-from datetime import datetime
+import threading
+import time
+import zlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from contextlib import closing, contextmanager
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from werkzeug.exceptions import UnsupportedMediaType
+
+# MessagePack ingest is optional: pip install msgpack
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# File locks for STORAGE_BACKEND=segments, POSIX only
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Multi-process mode: WORKERS > 1 makes `python test.py` start that many worker processes
+# on consecutive ports. MESSAGE_QUEUE relays Socket.IO events between them: 'sqlite' for the
+# built-in relay through a local file, or a redis:// or amqp:// URL.
+WORKERS = int(os.environ.get('WORKERS', 1))
+WORKER_INDEX = os.environ.get('WORKER_INDEX')  # set by the launcher in each worker
+IS_LAUNCHER = WORKERS > 1 and WORKER_INDEX is None
+MESSAGE_QUEUE = os.environ.get('MESSAGE_QUEUE', 'sqlite' if WORKERS > 1 else '')
+MESSAGE_QUEUE_POLL_MS = float(os.environ.get('MESSAGE_QUEUE_POLL_MS', 20))
+MESSAGE_QUEUE_RETENTION_S = float(os.environ.get('MESSAGE_QUEUE_RETENTION_S', 60))
+# How often a worker picks up the card states written by the other workers
+SHARED_STATE_REFRESH_MS = float(os.environ.get('SHARED_STATE_REFRESH_MS', 100))
+
+class SQLitePubSubManager(python_socketio.PubSubManager):
+    """Socket.IO client manager relaying events between processes through a SQLite file.
+
+    A stand-in for Redis when every worker runs on the same host: each worker appends
+    the events it emits to a table and polls it for the ones appended by the others.
+    """
+    name = 'sqlite'
+
+    def __init__(self, path, channel='socketio', write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = self._connect()
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                channel TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                created_ms INTEGER NOT NULL
+            )
+        ''')
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _append(self, payload):
+        now_ms = int(time.time() * 1000)
+        with self._lock, self._conn:
+            self._conn.execute("INSERT INTO messages (channel, payload, created_ms) VALUES (?, ?, ?)",
+                               (self.channel, payload, now_ms))
+            if random.random() < 0.01:
+                self._conn.execute("DELETE FROM messages WHERE created_ms < ?",
+                                   (now_ms - MESSAGE_QUEUE_RETENTION_S * 1000,))
+
+    def _publish(self, data):
+        run_db(self._append, json.dumps(data))
+
+    def _fetch(self, conn, last_id):
+        return conn.execute("SELECT id, payload FROM messages WHERE id > ? AND channel = ? ORDER BY id",
+                            (last_id, self.channel)).fetchall()
+
+    def _handle_emit(self, message):
+        # Deltas from every worker reach the 'all' room through here, in the order this
+        # worker delivers them
+        if message.get('event') == 'detection_delta' and message.get('room') == 'all':
+            record_deltas(message['data'][0])  # data is the list of emit arguments
+        return super()._handle_emit(message)
+
+    def _listen(self):
+        conn = self._connect()
+        last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+        while True:
+            rows = run_db(self._fetch, conn, last_id)
+            for last_id, payload in rows:
+                yield json.loads(payload)
+            if not rows:
+                time.sleep(MESSAGE_QUEUE_POLL_MS / 1000)
+
+def message_queue_options():
+    """SocketIO keyword arguments selecting the cross-process message queue, if any"""
+    if not MESSAGE_QUEUE:
+        return {}
+    if MESSAGE_QUEUE == 'sqlite' or MESSAGE_QUEUE.startswith('sqlite:///'):
+        path = MESSAGE_QUEUE[len('sqlite:///'):] or 'socketio_queue.db'
+        return {"client_manager": SQLitePubSubManager(os.path.abspath(path))}
+    return {"message_queue": MESSAGE_QUEUE}
 
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})
-socketio = SocketIO(app, cors_allowed_origins="*")
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode=ASYNC_MODE, **message_queue_options())
 logging.basicConfig(level=logging.INFO)
 
+# Per-request and per-row details are not logged by default: VERBOSE_LOGGING=1 logs all of
+# them, LOG_SAMPLE_RATE=0.01 logs about 1% of requests
+VERBOSE_LOGGING = os.environ.get('VERBOSE_LOGGING', '0') == '1'
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', 0))
+
+# The dev server's one-line-per-request access log is part of the same switch
+if not VERBOSE_LOGGING:
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+def log_hot_path():
+    """True when the current hot-path event should be logged in detail"""
+    return VERBOSE_LOGGING or (LOG_SAMPLE_RATE > 0 and random.random() < LOG_SAMPLE_RATE)
+
 # Database configuration - Use full path to ensure consistency
-import os
 DB_NAME = os.path.abspath('detections.db')
-print(f"Database will be created at: {DB_NAME}")
 
-# Initialisation des données de détection pour deux cartes
-num_points = 2
-detection_data = [{"detection": 0, "x": None, "y": None} for _ in range(num_points)]
+# Maximum number of readings accepted by /send_detections in one request
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', 5000))
 
-def init_database():
-    """Initialize the SQLite database with detections table"""
+# SQLite connection pool and pragmas
+SQLITE_POOL_SIZE = int(os.environ.get('SQLITE_POOL_SIZE', 8))
+SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')  # OFF, NORMAL, FULL or EXTRA
+SQLITE_CACHE_SIZE = int(os.environ.get('SQLITE_CACHE_SIZE', -20000))  # negative = KiB
+SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', 268435456))  # bytes
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))
+SQLITE_STATEMENT_CACHE = int(os.environ.get('SQLITE_STATEMENT_CACHE', 256))
+
+# Rows fetched from SQLite per round trip while streaming /export_detections
+EXPORT_FETCH_SIZE = int(os.environ.get('EXPORT_FETCH_SIZE', 1000))
+
+# Number of OS threads running SQLite calls for request handlers in gevent mode
+DB_EXECUTOR_THREADS = int(os.environ.get('DB_EXECUTOR_THREADS', 8))
+
+# Write-behind ingest: handlers enqueue readings and a writer thread group-commits them
+WRITE_BEHIND = os.environ.get('WRITE_BEHIND', '0') == '1'
+WRITE_BEHIND_QUEUE_SIZE = int(os.environ.get('WRITE_BEHIND_QUEUE_SIZE', 10000))
+WRITE_BEHIND_BATCH_SIZE = int(os.environ.get('WRITE_BEHIND_BATCH_SIZE', 500))
+WRITE_BEHIND_FLUSH_INTERVAL = float(os.environ.get('WRITE_BEHIND_FLUSH_INTERVAL', 0.05))  # seconds
+
+# Card registry: cards listed here are always registered, and unknown cards are
+# registered on their first reading unless AUTO_REGISTER_CARDS=0
+DEFAULT_CARDS = [int(v) for v in os.environ.get('DEFAULT_CARDS', '1,2').split(',') if v.strip()]
+AUTO_REGISTER_CARDS = os.environ.get('AUTO_REGISTER_CARDS', '1') == '1'
+
+# Socket.IO deltas: 0 emits each update immediately, otherwise updates are merged per
+# card and flushed once per window
+EMIT_COALESCE_MS = float(os.environ.get('EMIT_COALESCE_MS', 0))
+
+# Recent deltas kept in memory so a reconnecting client can 'resume' from its last seq
+# instead of refetching everything (0 disables replay)
+DELTA_BUFFER_SIZE = int(os.environ.get('DELTA_BUFFER_SIZE', 5000))
+
+# Pagination of card lists and aggregate rows
+DEFAULT_PAGE_SIZE = int(os.environ.get('DEFAULT_PAGE_SIZE', 100))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 500))
+
+# Rendered responses of the polled read endpoints kept in memory (0 disables the cache)
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 256))
+
+# Largest number of buckets /detections_histogram returns for one request
+MAX_HISTOGRAM_BUCKETS = int(os.environ.get('MAX_HISTOGRAM_BUCKETS', 10000))
+
+# Retention: raw readings older than RETENTION_DAYS (0 = keep everything) are moved to one
+# archive database per UTC month in ARCHIVE_DIR. The hourly and daily rollups are kept.
+RETENTION_DAYS = int(os.environ.get('RETENTION_DAYS', 0))
+ARCHIVE_DIR = os.path.abspath(os.environ.get('ARCHIVE_DIR', 'archive'))
+COMPACTION_BATCH_SIZE = int(os.environ.get('COMPACTION_BATCH_SIZE', 5000))  # rows per transaction
+COMPACTION_INTERVAL = float(os.environ.get('COMPACTION_INTERVAL', 3600))  # seconds between passes
+COMPACTION_PAUSE = float(os.environ.get('COMPACTION_PAUSE', 0.05))  # seconds between batches
+
+# Where raw readings live: 'sqlite' (the detections table) or 'segments' (per-card column
+# files in SEGMENT_DIR). Cards, rollups and the latest state are in SQLite either way.
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'sqlite')
+SEGMENT_DIR = os.path.abspath(os.environ.get('SEGMENT_DIR', 'segments'))
+
+# A reading already stored for the same card and timestamp (a retransmission) is skipped.
+# Only that conflict is ignored: OR IGNORE would also hide NOT NULL violations.
+INSERT_DETECTION_SQL = '''
+    INSERT INTO detections (card_id, detection, timestamp_ms, datetime_formatted)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT (card_id, timestamp_ms) DO NOTHING
+'''
+
+# Keeps the newest reading of each card; a reading older than the stored one is skipped
+UPSERT_LATEST_STATE_SQL = '''
+    INSERT OR REPLACE INTO latest_state (card_id, detection, timestamp_ms, datetime_formatted)
+    SELECT ?1, ?2, ?3, ?4
+    WHERE NOT EXISTS (SELECT 1 FROM latest_state WHERE card_id = ?1 AND timestamp_ms > ?3)
+'''
+
+_db_pool = queue.LifoQueue(maxsize=SQLITE_POOL_SIZE)
+
+def open_connection():
+    """Open a new SQLite connection with WAL journaling and the configured pragmas"""
+    # check_same_thread=False: pooled connections are handed from one request thread to the next
+    conn = sqlite3.connect(DB_NAME, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000,
+                           check_same_thread=False, cached_statements=SQLITE_STATEMENT_CACHE)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA cache_size={SQLITE_CACHE_SIZE}")
+    conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    conn.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    return conn
+
+@contextmanager
+def db_connection():
+    """Borrow a pooled connection; statements prepared on it stay cached between uses"""
     try:
-        logging.info(f"Database path: {DB_NAME}")
-        logging.info(f"Database exists before init: {os.path.exists(DB_NAME)}")
-        
-        # Check if we can write to the directory
-        db_dir = os.path.dirname(DB_NAME)
-        if not db_dir:  # If DB_NAME is just a filename, use current directory
-            db_dir = os.getcwd()
-        logging.info(f"Database directory: {db_dir}")
-        logging.info(f"Directory writable: {os.access(db_dir, os.W_OK)}")
-        
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        
-        # Create table with IF NOT EXISTS
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS detections (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                card_id INTEGER NOT NULL,
-                detection INTEGER NOT NULL,
-                timestamp_ms INTEGER NOT NULL,
-                datetime_formatted TEXT NOT NULL,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        conn.commit()
-        
-        # Verify table was created
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='detections'")
-        table_exists = cursor.fetchone()
-        logging.info(f"Table 'detections' exists after creation: {table_exists is not None}")
-        
-        # Check if data exists after creation
-        cursor.execute("SELECT COUNT(*) FROM detections")
-        count = cursor.fetchone()[0]
-        logging.info(f"Records in database after init: {count}")
-        
-        # Show file size to verify it's actually being written
-        if os.path.exists(DB_NAME):
-            file_size = os.path.getsize(DB_NAME)
-            logging.info(f"Database file size: {file_size} bytes")
-        
-        conn.close()
+        conn = _db_pool.get_nowait()
+    except queue.Empty:
+        conn = open_connection()
+    try:
+        yield conn
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            _db_pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+def close_db_pool():
+    """Close every idle pooled connection"""
+    while True:
+        try:
+            _db_pool.get_nowait().close()
+        except queue.Empty:
+            break
+
+# Metrics exposed in Prometheus text format on /metrics
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Counter:
+    """Monotonic counter with one series per tuple of label values"""
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.label_names, labels)} {value}")
+        return lines
+
+class Histogram:
+    """Cumulative histogram with one series per tuple of label values"""
+
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}  # labels -> [per-bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((labels, list(series)) for labels, series in self._series.items())
+        for labels, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                label_text = _format_labels(self.label_names + ('le',), labels + (le,))
+                lines.append(f"{self.name}_bucket{label_text} {cumulative}")
+            label_text = _format_labels(self.label_names, labels)
+            lines.append(f"{self.name}_sum{label_text} {series[-1]}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{str(value)}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+REQUEST_LATENCY = Histogram('http_request_duration_seconds', 'HTTP request latency by route',
+                            ('route', 'method', 'status'))
+DB_LATENCY = Histogram('sqlite_operation_duration_seconds', 'SQLite query and commit time by operation',
+                       ('operation',))
+INGESTED_READINGS = Counter('ingest_readings_total', 'Readings received by the ingest endpoints', ('result',))
+SOCKETIO_EMITS = Counter('socketio_emits_total', 'Socket.IO emits by event', ('event',))
+SOCKETIO_DELTAS = Counter('socketio_deltas_total', 'Card deltas sent over Socket.IO')
+SOCKETIO_RESUMES = Counter('socketio_resumes_total', 'Socket.IO resume requests by result', ('result',))
+RESPONSE_CACHE_REQUESTS = Counter('response_cache_requests_total', 'Cached read endpoint requests by result',
+                                  ('result',))
+COMPACTED_READINGS = Counter('compacted_readings_total', 'Raw readings moved to the monthly archives')
+
+@contextmanager
+def db_timer(operation):
+    """Record the duration of a block of SQLite work under the given operation label"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        DB_LATENCY.observe((operation,), time.perf_counter() - start)
+
+if ASYNC_MODE == 'gevent':
+    from gevent.threadpool import ThreadPool
+    _db_executor = ThreadPool(DB_EXECUTOR_THREADS)
+else:
+    _db_executor = None
+
+def run_db(func, *args):
+    """Run a blocking database call; in gevent mode it goes to the bounded thread pool
+    so the event loop keeps serving other clients while SQLite works"""
+    if _db_executor is None:
+        return func(*args)
+    return _db_executor.apply(func, args)
+
+def fetch_all(query, params=()):
+    """Run a read query on a pooled connection and return all rows"""
+    with db_connection() as conn, db_timer('query'):
+        return conn.execute(query, params).fetchall()
+
+class ReadingStore(ABC):
+    """Storage of raw readings, used by the ingest path, the rollup and latest state
+    rebuilds and the histogram. Methods taking conn run in the caller's SQLite transaction.
+    """
+    name = None  # the STORAGE_BACKEND value
+
+    @abstractmethod
+    def insert(self, conn, readings):
+        """Store (card_id, detection, timestamp_ms, formatted_date) readings; returns a 'new'
+        flag per reading, False for a duplicate (card_id, timestamp_ms)"""
+
+    @contextmanager
+    def transaction(self):
+        """Wrap insert() calls: their readings are kept on success and dropped on error.
+        Callers commit SQLite after this block, so derived data never gets ahead of the raw
+        readings it can be rebuilt from. The default suits stores inside the SQLite transaction."""
+        yield
+
+    @abstractmethod
+    def card_readings(self, conn, card_id, start_ms, end_ms):
+        """(card_id, detection, timestamp_ms) rows of one card in [start_ms, end_ms), in time order"""
+
+    @abstractmethod
+    def scan(self, conn, since_ms):
+        """(card_id, detection, timestamp_ms) rows from since_ms on, ordered by card then time"""
+
+    @abstractmethod
+    def latest(self, conn):
+        """(card_id, detection, datetime_formatted, timestamp_ms) of the newest reading of each card"""
+
+    @abstractmethod
+    def histogram(self, start_ms, end_ms, slot_ms, card_ids):
+        """(card_id, slot_ms, increment) rows, as described in build_histogram_query"""
+
+    @abstractmethod
+    def count(self, conn):
+        """Number of stored readings"""
+
+    @abstractmethod
+    def delete_all(self, conn):
+        """Remove every reading"""
+
+class SQLiteStore(ReadingStore):
+    """Raw readings in the detections table, in the same transaction as everything else"""
+    name = 'sqlite'
+
+    def insert(self, conn, readings):
+        return [conn.execute(INSERT_DETECTION_SQL, reading).rowcount == 1 for reading in readings]
+
+    def card_readings(self, conn, card_id, start_ms, end_ms):
+        return conn.execute('''
+            SELECT card_id, detection, timestamp_ms FROM detections
+            WHERE card_id = ? AND timestamp_ms >= ? AND timestamp_ms < ?
+            ORDER BY timestamp_ms, id
+        ''', (card_id, start_ms, end_ms))
+
+    def scan(self, conn, since_ms):
+        return conn.execute('''
+            SELECT card_id, detection, timestamp_ms FROM detections
+            WHERE timestamp_ms >= ? ORDER BY card_id, timestamp_ms, id
+        ''', (since_ms,))
+
+    def latest(self, conn):
+        return conn.execute(LATEST_DETECTIONS_SQL).fetchall()
+
+    def histogram(self, start_ms, end_ms, slot_ms, card_ids):
+        return fetch_all(*build_histogram_query(start_ms, end_ms, slot_ms, card_ids))
+
+    def count(self, conn):
+        return conn.execute("SELECT COUNT(*) FROM detections").fetchone()[0]
+
+    def delete_all(self, conn):
+        conn.execute("DELETE FROM detections")
+        # Reset the auto-increment counter
+        conn.execute("DELETE FROM sqlite_sequence WHERE name='detections'")
+
+# Segment file: a header, then a timestamp_ms column and a detection column of `capacity`
+# int64 slots each. Readings are sorted by time and the first `count` slots are used.
+# Appends fill the next slots and then update count, so a reader that maps the file sees
+# either the old or the new readings. A late reading or a full file rewrites the segment to
+# a new file that replaces the old one.
+SEGMENT_HEADER = struct.Struct('<4sIQQ')  # magic, version, capacity, count
+SEGMENT_MAGIC = b'DSEG'
+SEGMENT_INITIAL_CAPACITY = 1024
+
+@contextmanager
+def mapped_segment(path):
+    """Yield (capacity, timestamps, detections) of a segment file, as int64 memoryviews over
+    its used part; (0, (), ()) when the file is missing or empty"""
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        yield 0, (), ()
+        return
+    with f:
+        if os.fstat(f.fileno()).st_size < SEGMENT_HEADER.size:
+            yield 0, (), ()
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            _, _, capacity, count = SEGMENT_HEADER.unpack_from(mapped)
+            view = memoryview(mapped)
+            det_start = SEGMENT_HEADER.size + capacity * 8
+            ts = view[SEGMENT_HEADER.size:SEGMENT_HEADER.size + count * 8].cast('q')
+            det = view[det_start:det_start + count * 8].cast('q')
+            try:
+                yield capacity, ts, det
+            finally:
+                ts.release()
+                det.release()
+                view.release()
+
+class SegmentWrite:
+    """Readings staged for one segment file by a transaction, which holds the store lock.
+
+    No file stays open between calls, so a batch can touch any number of segments.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with mapped_segment(path) as (self.capacity, ts, _):
+            self.count = len(ts)
+            self.newest = ts[-1] if self.count else None
+        self.appended = {}  # newer than every stored reading, in arrival order
+        self.late = {}  # older than the newest stored reading
+
+    def add(self, stored_ts, timestamp_ms, detection):
+        """Stage one reading, given the mapped stored timestamps; returns False for a duplicate"""
+        if timestamp_ms in self.appended or timestamp_ms in self.late:
+            return False
+        newest = next(reversed(self.appended)) if self.appended else self.newest
+        if newest is None or timestamp_ms > newest:
+            self.appended[timestamp_ms] = detection
+            return True
+        index = bisect.bisect_left(stored_ts, timestamp_ms)
+        if index < self.count and stored_ts[index] == timestamp_ms:
+            return False
+        self.late[timestamp_ms] = detection
         return True
-        
-    except Exception as e:
-        logging.error(f"Database initialization error: {e}")
-        return False
 
-@app.route('/empty_database', methods=['GET'])
-def empty_database():
-    """Empty all data from the detections table"""
+    def columns(self):
+        """Return (timestamps, detections) int64 arrays including the staged readings"""
+        with mapped_segment(self.path) as (_, ts, det):
+            readings = sorted([*zip(ts, det), *self.appended.items(), *self.late.items()])
+        return array.array('q', [ts for ts, _ in readings]), array.array('q', [det for _, det in readings])
+
+    def publish(self):
+        total = self.count + len(self.appended) + len(self.late)
+        if total == self.count:
+            return
+        if self.late or total > self.capacity:
+            self.rewrite(*self.columns())
+            return
+        end = SEGMENT_HEADER.size + self.count * 8
+        # Not O_APPEND: Linux pwrite() would ignore the offset
+        fd = os.open(self.path, os.O_RDWR)
+        try:
+            os.pwrite(fd, array.array('q', self.appended).tobytes(), end)
+            os.pwrite(fd, array.array('q', self.appended.values()).tobytes(), end + self.capacity * 8)
+            os.pwrite(fd, SEGMENT_HEADER.pack(SEGMENT_MAGIC, 1, self.capacity, total), 0)
+        finally:
+            os.close(fd)
+
+    def rewrite(self, timestamps, detections):
+        capacity = SEGMENT_INITIAL_CAPACITY
+        while capacity < len(timestamps) * 2:
+            capacity *= 2
+        padding = bytes((capacity - len(timestamps)) * 8)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, 1, capacity, len(timestamps)))
+            f.write(array.array('q', timestamps).tobytes() + padding)
+            f.write(array.array('q', detections).tobytes() + padding)
+        os.replace(tmp_path, self.path)
+
+class SegmentStore(ReadingStore):
+    """Append-only, memory-mapped column files: one per card and UTC month,
+    SEGMENT_DIR/<card_id>/<YYYY-MM>.seg, holding int64 timestamp and detection arrays
+    (16 bytes per reading). Range reads binary-search the mapped timestamp column and
+    copy the matching slices in one call, instead of fetching one row at a time.
+
+    Writers of every thread and process take one lock, SEGMENT_DIR/.lock, for the whole
+    transaction. SQLite already runs one write transaction at a time, so this costs little
+    concurrency, and a transaction holds one file descriptor however many segments it writes.
+    """
+    name = 'segments'
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._local = threading.local()
+
+    def segment_path(self, card_id, timestamp_ms):
+        month = datetime.fromtimestamp(timestamp_ms / 1000, tz=timezone.utc)
+        return os.path.join(self.directory, str(card_id), f"{month:%Y-%m}.seg")
+
+    def card_ids(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(int(name) for name in os.listdir(self.directory) if name.isdigit())
+
+    def segment_paths(self, card_id, start_ms=None, end_ms=None):
+        """Segment files of a card overlapping [start_ms, end_ms), oldest first"""
+        card_dir = os.path.join(self.directory, str(card_id))
+        if not os.path.isdir(card_dir):
+            return []
+        first = os.path.basename(self.segment_path(card_id, start_ms)) if start_ms is not None else ''
+        last = os.path.basename(self.segment_path(card_id, end_ms - 1)) if end_ms is not None else '~'
+        return [os.path.join(card_dir, name) for name in sorted(os.listdir(card_dir))
+                if name.endswith('.seg') and first <= name <= last]
+
+    def staged(self):
+        if not hasattr(self._local, 'writes'):
+            self._local.writes = {}
+        return self._local.writes
+
+    @contextmanager
+    def locked(self):
+        """Hold the store-wide writer lock"""
+        os.makedirs(self.directory, exist_ok=True)
+        fd = os.open(os.path.join(self.directory, '.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)  # releases the lock
+
+    @contextmanager
+    def open_columns(self, path):
+        """Yield the (timestamps, detections) of a segment, with this thread's staged readings"""
+        write = self.staged().get(path)
+        if write is not None:
+            yield write.columns()
+            return
+        with mapped_segment(path) as (_, ts, det):
+            yield ts, det
+
+    def insert(self, conn, readings):
+        groups = {}
+        for index, (card_id, detection, timestamp_ms, _) in enumerate(readings):
+            timestamp_ms = int(timestamp_ms)
+            groups.setdefault(self.segment_path(card_id, timestamp_ms), []).append((index, timestamp_ms, detection))
+        flags = [False] * len(readings)
+        writes = self.staged()
+        for path, group in groups.items():
+            if path not in writes:
+                writes[path] = SegmentWrite(path)
+            with mapped_segment(path) as (_, stored_ts, _):
+                for index, timestamp_ms, detection in group:
+                    flags[index] = writes[path].add(stored_ts, timestamp_ms, int(detection))
+        return flags
+
+    @contextmanager
+    def transaction(self):
+        writes = self.staged()
+        with self.locked():
+            try:
+                yield
+                for write in writes.values():
+                    write.publish()
+            finally:
+                writes.clear()
+
+    def card_readings(self, conn, card_id, start_ms, end_ms):
+        rows = []
+        for path in self.segment_paths(card_id, start_ms, end_ms):
+            with self.open_columns(path) as (ts, det):
+                lo = bisect.bisect_left(ts, start_ms)
+                hi = bisect.bisect_left(ts, end_ms)
+                rows.extend(zip([card_id] * (hi - lo), det[lo:hi].tolist(), ts[lo:hi].tolist()))
+        return rows
+
+    def scan(self, conn, since_ms):
+        for card_id in self.card_ids():
+            # Validated timestamps are at most MAX_TIMESTAMP_MS
+            yield from self.card_readings(conn, card_id, since_ms, MAX_TIMESTAMP_MS + 1)
+
+    def latest(self, conn):
+        rows = []
+        for card_id in self.card_ids():
+            for path in reversed(self.segment_paths(card_id)):
+                with self.open_columns(path) as (ts, det):
+                    if len(ts):
+                        rows.append((card_id, det[-1], convert_timestamp_to_datetime(ts[-1]), ts[-1]))
+                        break
+        return rows
+
+    def histogram(self, start_ms, end_ms, slot_ms, card_ids):
+        if slot_ms == HOUR_MS:
+            return fetch_all(*build_histogram_query(start_ms, end_ms, slot_ms, card_ids))
+        rows = []
+        for card_id in card_ids:
+            slots = {}
+            prev_ts = prev_detection = None
+            # Same increment rules as the SQL version, from UTC midnight before start_ms
+            for _, detection, timestamp_ms in self.card_readings(None, card_id, start_ms - start_ms % DAY_MS, end_ms):
+                if prev_ts is None or prev_ts // DAY_MS < timestamp_ms // DAY_MS or detection < prev_detection:
+                    increment = detection
+                else:
+                    increment = detection - prev_detection
+                prev_ts, prev_detection = timestamp_ms, detection
+                if timestamp_ms >= start_ms:
+                    slot = timestamp_ms - timestamp_ms % slot_ms
+                    slots[slot] = slots.get(slot, 0) + increment
+            rows.extend((card_id, slot, increment) for slot, increment in slots.items())
+        return rows
+
+    def count(self, conn):
+        total = 0
+        for card_id in self.card_ids():
+            for path in self.segment_paths(card_id):
+                with self.open_columns(path) as (ts, _):
+                    total += len(ts)
+        return total
+
+    def delete_all(self, conn):
+        # Keep the lock file: another process may be waiting on it
+        with self.locked():
+            for card_id in self.card_ids():
+                shutil.rmtree(os.path.join(self.directory, str(card_id)), ignore_errors=True)
+
+if STORAGE_BACKEND == 'segments':
+    if fcntl is None:
+        raise RuntimeError("STORAGE_BACKEND=segments needs a POSIX platform (fcntl)")
+    if RETENTION_DAYS > 0:
+        raise RuntimeError("RETENTION_DAYS is only supported with STORAGE_BACKEND=sqlite")
+    storage = SegmentStore(SEGMENT_DIR)
+elif STORAGE_BACKEND == 'sqlite':
+    storage = SQLiteStore()
+else:
+    raise RuntimeError(f"Unknown STORAGE_BACKEND {STORAGE_BACKEND}")
+
+def migrate_detections_table(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS detections (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            card_id INTEGER NOT NULL,
+            detection INTEGER NOT NULL,
+            timestamp_ms INTEGER NOT NULL,
+            datetime_formatted TEXT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # Index for per-card time-range lookups and one for cross-card time ranges
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_detections_card_ts ON detections (card_id, timestamp_ms)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_detections_ts ON detections (timestamp_ms)')
+
+def migrate_rollup_tables(conn):
+    # Rollups maintained on ingest: per-card increments per UTC hour, and per-card
+    # daily counts plus the last reading of the day used to compute the next increment
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS detections_hourly (
+            card_id INTEGER NOT NULL,
+            hour_ms INTEGER NOT NULL,
+            increment INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (card_id, hour_ms)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS detections_daily (
+            card_id INTEGER NOT NULL,
+            day_ms INTEGER NOT NULL,
+            detections_count INTEGER NOT NULL DEFAULT 0,
+            total_records INTEGER NOT NULL DEFAULT 0,
+            increment INTEGER NOT NULL DEFAULT 0,
+            last_timestamp_ms INTEGER,
+            last_detection INTEGER,
+            PRIMARY KEY (card_id, day_ms)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_detections_hourly_hour ON detections_hourly (hour_ms)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_detections_daily_day ON detections_daily (day_ms)')
+    # Databases from before the rollups have readings to backfill them from
+    has_readings = conn.execute("SELECT 1 FROM detections LIMIT 1").fetchone() is not None
+    has_rollups = conn.execute("SELECT 1 FROM detections_daily LIMIT 1").fetchone() is not None
+    if has_readings and not has_rollups:
+        rebuild_rollups_since(conn, 0)
+
+def migrate_cards_table(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS cards (
+            card_id INTEGER PRIMARY KEY,
+            site TEXT,
+            registered_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+def migrate_retention_state(conn):
+    # Compaction watermark: raw readings before it have been moved to the archives
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS retention_state (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+    ''')
+
+def migrate_latest_state(conn):
+    # Latest reading of every card, shared by the worker processes. seq grows on every
+    # update (REPLACE inserts a new row), so workers read only the rows changed since
+    # their last refresh.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS latest_state (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            card_id INTEGER NOT NULL UNIQUE,
+            detection INTEGER NOT NULL,
+            timestamp_ms INTEGER NOT NULL,
+            datetime_formatted TEXT NOT NULL
+        )
+    ''')
+    conn.execute(f'''
+        INSERT OR REPLACE INTO latest_state (card_id, detection, datetime_formatted, timestamp_ms)
+        {LATEST_DETECTIONS_SQL}
+    ''')
+
+def migrate_unique_readings(conn):
+    # Devices retransmit readings: keep the first one stored for each (card_id, timestamp_ms)
+    # and let the unique index reject the others from now on
+    removed = conn.execute('''
+        DELETE FROM detections WHERE EXISTS (
+            SELECT 1 FROM detections AS first
+            WHERE first.card_id = detections.card_id
+              AND first.timestamp_ms = detections.timestamp_ms
+              AND first.id < detections.id
+        )
+    ''').rowcount
+    conn.execute("DROP INDEX IF EXISTS idx_detections_card_ts")
+    conn.execute("CREATE UNIQUE INDEX idx_detections_card_ts ON detections (card_id, timestamp_ms)")
+    if removed:
+        logging.info(f"Removed {removed} duplicate readings")
+        rebuild_rollups_since(conn, load_retention_watermark(conn))
+        rebuild_latest_state(conn)
+
+def migrate_import_progress(conn):
+    # Files loaded by 'flask import-detections': offset is the byte position after the
+    # last committed line, so an interrupted import resumes there
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS import_progress (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            offset INTEGER NOT NULL DEFAULT 0,
+            rows INTEGER NOT NULL DEFAULT 0,
+            rejected INTEGER NOT NULL DEFAULT 0,
+            finished_at DATETIME
+        )
+    ''')
+
+def rebuild_latest_state(conn):
+    """Recompute the shared latest state of every card from raw readings, in the caller's transaction"""
+    conn.execute("DELETE FROM latest_state")
+    conn.executemany('''
+        INSERT INTO latest_state (card_id, detection, datetime_formatted, timestamp_ms) VALUES (?, ?, ?, ?)
+    ''', storage.latest(conn))
+
+# Schema migrations, applied in order. PRAGMA user_version holds the number of the last
+# one applied. Append new steps at the end and never edit a released one; every step uses
+# IF NOT EXISTS so databases created before versioning are brought forward safely.
+MIGRATIONS = [
+    (1, "detections table and indexes", migrate_detections_table),
+    (2, "hourly and daily rollups", migrate_rollup_tables),
+    (3, "card registry", migrate_cards_table),
+    (4, "retention watermark", migrate_retention_state),
+    (5, "shared latest card state", migrate_latest_state),
+    (6, "unique readings per card and timestamp", migrate_unique_readings),
+    (7, "bulk import progress", migrate_import_progress),
+]
+
+def init_database():
+    """Apply the pending schema migrations; runs once per process at startup"""
+    latest = MIGRATIONS[-1][0]
+    with db_connection() as conn:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version > latest:
+            raise RuntimeError(f"{DB_NAME} has schema version {version}, newer than this code ({latest})")
+        for number, description, migrate in MIGRATIONS:
+            if number <= version:
+                continue
+            # BEGIN IMMEDIATE takes the write lock before re-reading the version, so two
+            # processes starting together do not apply the same step twice
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if conn.execute("PRAGMA user_version").fetchone()[0] < number:
+                    logging.info(f"Applying migration {number}: {description}")
+                    migrate(conn)
+                    conn.execute(f"PRAGMA user_version = {number}")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+    return True
+
+HOUR_MS = 3600 * 1000
+DAY_MS = 24 * HOUR_MS
+
+def accumulate_rollups(rows, hourly, daily):
+    """Fold (card_id, detection, timestamp_ms) readings, sorted by card then time, into rollup buckets.
+
+    hourly maps (card_id, hour_ms) -> increment and daily maps (card_id, day_ms) ->
+    [detections_count, total_records, increment, last_timestamp_ms, last_detection].
+    Detection values are cumulative counters: the first reading of a day counts as-is,
+    later ones count their difference from the previous reading, and a negative
+    difference (sensor reset) counts the current value instead.
+    """
+    for card_id, detection, timestamp_ms in rows:
+        timestamp_ms = int(timestamp_ms)
+        day_key = (card_id, timestamp_ms - timestamp_ms % DAY_MS)
+        day = daily.get(day_key)
+        if day is None:
+            day = daily[day_key] = [0, 0, 0, None, None]
+            increment = detection
+        else:
+            increment = detection - day[4]
+            if increment < 0:
+                if log_hot_path():
+                    logging.warning(f"Trap {card_id} - Negative increment detected: {increment}. Using current value instead.")
+                increment = detection  # Use current value when sensor resets
+        
+        day[1] += 1
+        if detection == 1:
+            day[0] += 1
+        day[2] += increment
+        day[3] = timestamp_ms
+        day[4] = detection
+        hour_key = (card_id, timestamp_ms - timestamp_ms % HOUR_MS)
+        hourly[hour_key] = hourly.get(hour_key, 0) + increment
+
+def write_rollups(conn, hourly, daily, replace_hourly=False):
+    """Write accumulated buckets; hourly increments are added to stored ones unless replace_hourly"""
+    if replace_hourly:
+        conn.executemany('''
+            INSERT OR REPLACE INTO detections_hourly (card_id, hour_ms, increment) VALUES (?, ?, ?)
+        ''', [(card_id, hour_ms, increment) for (card_id, hour_ms), increment in hourly.items()])
+    else:
+        conn.executemany('''
+            INSERT INTO detections_hourly (card_id, hour_ms, increment) VALUES (?, ?, ?)
+            ON CONFLICT (card_id, hour_ms) DO UPDATE SET increment = increment + excluded.increment
+        ''', [(card_id, hour_ms, increment) for (card_id, hour_ms), increment in hourly.items()])
+    conn.executemany('''
+        INSERT OR REPLACE INTO detections_daily
+            (card_id, day_ms, detections_count, total_records, increment, last_timestamp_ms, last_detection)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', [(card_id, day_ms, *day) for (card_id, day_ms), day in daily.items()])
+
+def rebuild_card_day_rollups(conn, card_id, day_ms):
+    """Recompute the rollups of one card and one UTC day from raw readings"""
+    conn.execute("DELETE FROM detections_hourly WHERE card_id = ? AND hour_ms >= ? AND hour_ms < ?",
+                 (card_id, day_ms, day_ms + DAY_MS))
+    conn.execute("DELETE FROM detections_daily WHERE card_id = ? AND day_ms = ?", (card_id, day_ms))
+    hourly, daily = {}, {}
+    accumulate_rollups(storage.card_readings(conn, card_id, day_ms, day_ms + DAY_MS), hourly, daily)
+    write_rollups(conn, hourly, daily, replace_hourly=True)
+
+def apply_rollups(conn, readings):
+    """Update the rollups for freshly inserted (card_id, detection, timestamp_ms, ...) readings.
+
+    Runs inside the insert transaction. A reading older than the last one already rolled
+    up for its card and day cannot be folded in incrementally, so that card-day is
+    recomputed from raw rows instead.
+    """
+    hourly, daily = {}, {}
+    late_days = set()
+    for card_id, detection, timestamp_ms, *_ in sorted(readings, key=lambda r: (r[0], r[2])):
+        timestamp_ms = int(timestamp_ms)
+        day_key = (card_id, timestamp_ms - timestamp_ms % DAY_MS)
+        if day_key in late_days:
+            continue
+        if day_key not in daily:
+            stored = conn.execute('''
+                SELECT detections_count, total_records, increment, last_timestamp_ms, last_detection
+                FROM detections_daily WHERE card_id = ? AND day_ms = ?
+            ''', day_key).fetchone()
+            if stored is not None:
+                if timestamp_ms < stored[3]:
+                    if day_key[1] < retention_watermark_ms:
+                        # The raw rows of that day are archived, its rollups can no longer be recomputed
+                        logging.warning(f"Trap {card_id} - Late reading for compacted day {day_key[1]} not rolled up")
+                    else:
+                        late_days.add(day_key)
+                    continue
+                daily[day_key] = list(stored)
+        accumulate_rollups([(card_id, detection, timestamp_ms)], hourly, daily)
+    
+    write_rollups(conn, hourly, daily)
+    for card_id, day_ms in late_days:
+        rebuild_card_day_rollups(conn, card_id, day_ms)
+
+def rebuild_rollups():
+    """Regenerate the hourly and daily rollups from the raw detections table.
+
+    Days before the compaction watermark have no raw rows left, so their rollups are kept.
+    """
+    with db_connection() as conn:
+        with conn:
+            hourly_count, daily_count = rebuild_rollups_since(conn, load_retention_watermark(conn))
+    return hourly_count, daily_count
+
+def rebuild_rollups_since(conn, since_ms):
+    """Replace the rollups from since_ms on with ones computed from raw readings, in the caller's transaction"""
+    conn.execute("DELETE FROM detections_hourly WHERE hour_ms >= ?", (since_ms,))
+    conn.execute("DELETE FROM detections_daily WHERE day_ms >= ?", (since_ms,))
+    hourly, daily = {}, {}
+    accumulate_rollups(storage.scan(conn, since_ms), hourly, daily)
+    write_rollups(conn, hourly, daily, replace_hourly=True)
+    logging.info(f"Rollups rebuilt: {len(hourly)} hourly and {len(daily)} daily buckets")
+    return len(hourly), len(daily)
+
+@app.cli.command('rebuild-rollups')
+def rebuild_rollups_command():
+    """Regenerate the hourly and daily rollup tables from raw detections"""
+    hourly_count, daily_count = rebuild_rollups()
+    print(f"Rebuilt {hourly_count} hourly and {daily_count} daily buckets")
+
+retention_watermark_ms = 0  # UTC midnight; raw readings before it live in the archives
+_compaction_lock = threading.Lock()
+_compaction_stop = threading.Event()
+_compaction_thread = None
+
+ARCHIVE_FILE_PATTERN = re.compile(r'detections-(\d{4})-(\d{2})\.db')
+
+def load_retention_watermark(conn):
+    """Read the compaction watermark from the database and cache it"""
+    global retention_watermark_ms
+    row = conn.execute("SELECT value FROM retention_state WHERE key = 'watermark_ms'").fetchone()
+    retention_watermark_ms = row[0] if row else 0
+    return retention_watermark_ms
+
+def month_bounds(timestamp_ms):
+    """Return the [start, end) epoch milliseconds of the UTC month containing timestamp_ms"""
+    start = datetime.fromtimestamp(timestamp_ms / 1000, tz=timezone.utc).replace(
+        day=1, hour=0, minute=0, second=0, microsecond=0)
+    if start.month == 12:
+        end = start.replace(year=start.year + 1, month=1)
+    else:
+        end = start.replace(month=start.month + 1)
+    return int(start.timestamp() * 1000), int(end.timestamp() * 1000)
+
+def archive_path(month_start_ms):
+    month = datetime.fromtimestamp(month_start_ms / 1000, tz=timezone.utc)
+    return os.path.join(ARCHIVE_DIR, f"detections-{month:%Y-%m}.db")
+
+def archive_partitions():
+    """List (month_start_ms, month_end_ms, path) for the archive files on disk, oldest first"""
+    partitions = []
+    if os.path.isdir(ARCHIVE_DIR):
+        for name in os.listdir(ARCHIVE_DIR):
+            match = ARCHIVE_FILE_PATTERN.fullmatch(name)
+            if match:
+                month = datetime(int(match[1]), int(match[2]), 1, tzinfo=timezone.utc)
+                partitions.append((*month_bounds(month.timestamp() * 1000), os.path.join(ARCHIVE_DIR, name)))
+    return sorted(partitions)
+
+def create_archive_schema(conn):
+    """Create the detections table of the database attached as 'archive'"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS archive.detections (
+            id INTEGER PRIMARY KEY,
+            card_id INTEGER NOT NULL,
+            detection INTEGER NOT NULL,
+            timestamp_ms INTEGER NOT NULL,
+            datetime_formatted TEXT NOT NULL,
+            created_at DATETIME
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS archive.idx_detections_card_ts ON detections (card_id, timestamp_ms)')
+    conn.execute('CREATE INDEX IF NOT EXISTS archive.idx_detections_ts ON detections (timestamp_ms)')
+
+def advance_retention_watermark(conn):
+    """Move the watermark up to the current retention cutoff, before any row below it is archived"""
+    global retention_watermark_ms
+    cutoff = (int(time.time() * 1000) - RETENTION_DAYS * DAY_MS) // DAY_MS * DAY_MS
+    if cutoff > retention_watermark_ms:
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO retention_state (key, value) VALUES ('watermark_ms', ?)", (cutoff,))
+        retention_watermark_ms = cutoff
+
+def compact_batch(conn):
+    """Move the oldest readings below the watermark, up to one batch, to their month's archive.
+
+    Returns the number of rows moved. Each batch is a single short transaction, so ingest
+    only waits for one batch at a time.
+    """
+    oldest = conn.execute("SELECT MIN(timestamp_ms) FROM detections").fetchone()[0]
+    if oldest is None or oldest >= retention_watermark_ms:
+        return 0
+    month_start, month_end = month_bounds(oldest)
+    bound = min(retention_watermark_ms, month_end)
+    edge = conn.execute('''
+        SELECT timestamp_ms FROM detections WHERE timestamp_ms < ?
+        ORDER BY timestamp_ms LIMIT 1 OFFSET ?
+    ''', (bound, COMPACTION_BATCH_SIZE)).fetchone()
+    if edge is not None and edge[0] > oldest:
+        bound = edge[0]
+    
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    conn.execute("ATTACH DATABASE ? AS archive", (archive_path(month_start),))
+    try:
+        create_archive_schema(conn)
+        with conn:
+            # OR IGNORE: rows copied by a batch interrupted before its delete are not duplicated
+            conn.execute('''
+                INSERT OR IGNORE INTO archive.detections
+                SELECT id, card_id, detection, timestamp_ms, datetime_formatted, created_at
+                FROM main.detections WHERE timestamp_ms < ?
+            ''', (bound,))
+            moved = conn.execute("DELETE FROM main.detections WHERE timestamp_ms < ?", (bound,)).rowcount
+    finally:
+        conn.execute("DETACH DATABASE archive")
+    return moved
+
+def compact_detections():
+    """Archive every raw reading older than the retention window; returns the number moved"""
+    moved = 0
+    conn = open_connection()
     try:
-        conn = sqlite3.connect(DB_NAME)
+        while not _compaction_stop.is_set():
+            with _compaction_lock:
+                load_retention_watermark(conn)
+                advance_retention_watermark(conn)
+                with db_timer('compact'):
+                    count = compact_batch(conn)
+            if not count:
+                break
+            moved += count
+            COMPACTED_READINGS.inc((), count)
+            time.sleep(COMPACTION_PAUSE)
+    finally:
+        conn.close()
+    if moved:
+        logging.info(f"Compaction moved {moved} readings older than {RETENTION_DAYS} days to {ARCHIVE_DIR}")
+    return moved
+
+def compaction_worker():
+    """Run a compaction pass every COMPACTION_INTERVAL seconds"""
+    while not _compaction_stop.is_set():
+        try:
+            compact_detections()
+        except Exception as e:
+            logging.error(f"Compaction error: {e}")
+        _compaction_stop.wait(COMPACTION_INTERVAL)
+
+def start_compaction():
+    """Start the background compaction thread"""
+    global _compaction_thread
+    if _compaction_thread is None:
+        _compaction_thread = threading.Thread(target=compaction_worker, name="compaction", daemon=True)
+        _compaction_thread.start()
+        atexit.register(stop_compaction)
+        logging.info(f"Retention enabled: readings older than {RETENTION_DAYS} days move to {ARCHIVE_DIR}")
+
+def stop_compaction():
+    """Stop the compaction thread after its current batch"""
+    global _compaction_thread
+    if _compaction_thread is not None:
+        _compaction_stop.set()
+        _compaction_thread.join()
+        _compaction_thread = None
+
+@app.cli.command('compact')
+def compact_command():
+    """Move raw readings older than RETENTION_DAYS to the monthly archives"""
+    if RETENTION_DAYS <= 0:
+        raise SystemExit("Set RETENTION_DAYS to compact")
+    moved = compact_detections()
+    print(f"Archived {moved} readings, watermark {retention_watermark_ms}")
+
+def delete_all_detections():
+    """Delete every reading, rollup and archive; returns the number of live readings deleted"""
+    global retention_watermark_ms
+    with _compaction_lock, db_connection() as conn:
         cursor = conn.cursor()
         
         # Get count before deletion
-        cursor.execute("SELECT COUNT(*) FROM detections")
-        count_before = cursor.fetchone()[0]
+        count_before = storage.count(conn)
         logging.info(f"Records before deletion: {count_before}")
         
         # Delete all records
-        cursor.execute("DELETE FROM detections")
+        storage.delete_all(conn)
         
-        # Reset the auto-increment counter
-        cursor.execute("DELETE FROM sqlite_sequence WHERE name='detections'")
+        cursor.execute("DELETE FROM detections_hourly")
+        cursor.execute("DELETE FROM detections_daily")
+        cursor.execute("DELETE FROM latest_state")
+        cursor.execute("DELETE FROM retention_state")
         
         conn.commit()
+        retention_watermark_ms = 0
+        
+        # Archived ids would clash with the restarted id sequence
+        for _, _, path in archive_partitions():
+            os.remove(path)
         
         # Verify deletion
-        cursor.execute("SELECT COUNT(*) FROM detections")
-        count_after = cursor.fetchone()[0]
+        count_after = storage.count(conn)
         logging.info(f"Records after deletion: {count_after}")
+    return count_before
+
+@app.route('/empty_database', methods=['GET'])
+def empty_database():
+    """Empty all data from the detections table"""
+    try:
+        count_before = run_db(delete_all_detections)
         
-        conn.close()
+        # Cards stay registered, their latest reading goes back to the defaults
+        with registry_lock:
+            for state in card_registry.values():
+                state.reset()
+        clear_recent_deltas()
+        bump_data_version()
         
         logging.info(f"Database emptied successfully. Deleted {count_before} records.")
-        return True, f"Successfully deleted {count_before} records"
+        return jsonify({"message": f"Successfully deleted {count_before} records"}), 200
         
     except Exception as e:
         logging.error(f"Error emptying database: {e}")
-        return False, f"Error: {str(e)}"
-    """Save detection data to SQLite database"""
-    try:
-        # Debug: Log current working directory and database path
-        current_dir = os.getcwd()
-        logging.info(f"Current working directory: {current_dir}")
-        logging.info(f"Attempting to write to database: {DB_NAME}")
-        
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO detections (card_id, detection, timestamp_ms, datetime_formatted)
-            VALUES (?, ?, ?, ?)
-        ''', (card_id, detection, timestamp_ms, formatted_date))
-        
-        conn.commit()
-        conn.close()
-        
-        # IMMEDIATE verification after insert
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM detections")
-        count_after_insert = cursor.fetchone()[0]
-        cursor.execute("SELECT * FROM detections WHERE card_id = ? ORDER BY created_at DESC LIMIT 1", (card_id,))
-        last_inserted = cursor.fetchone()
-        conn.close()
-        
-        logging.info(f"Saved to DB - Card: {card_id}, Detection: {detection}, Time: {formatted_date}")
-        logging.info(f"Total records after insert: {count_after_insert}")
-        logging.info(f"Last inserted record: {last_inserted}")
-        
-        # Check file metadata
-        if os.path.exists(DB_NAME):
-            file_size = os.path.getsize(DB_NAME)
-            mod_time = os.path.getmtime(DB_NAME)
-            logging.info(f"Database file size after insert: {file_size} bytes, modified: {mod_time}")
-        
-        return True
-    except Exception as e:
-        logging.error(f"Database error: {e}")
-        logging.error(f"Failed to save - Card: {card_id}, Detection: {detection}")
-        return False
+        return jsonify({"error": f"Error: {str(e)}"}), 500
 
 def convert_timestamp_to_datetime(timestamp_ms):
     """Convertit un timestamp en date formatée"""
@@ -156,101 +1196,574 @@ def convert_timestamp_to_datetime(timestamp_ms):
         logging.error(f"Erreur conversion timestamp: {e}")
         return str(timestamp_ms)
 
+class InvalidCardError(ValueError):
+    """Raised when a reading references an unknown card"""
+
+# Card ids and counters are stored as SQLite INTEGERs (int64). Timestamps must also fit
+# datetime, with a day of margin for the local time zone.
+MAX_INT64 = 2 ** 63 - 1
+MIN_TIMESTAMP_MS = int(datetime(1, 1, 2, tzinfo=timezone.utc).timestamp() * 1000)
+MAX_TIMESTAMP_MS = int(datetime(9999, 12, 31, tzinfo=timezone.utc).timestamp() * 1000)
+
+def parse_detection(data):
+    """Validate one reading payload and return (card_id, site, detection, timestamp, formatted_date)"""
+    if not isinstance(data, dict):
+        raise ValueError("Reading must be a JSON object")
+    x_val = float(data.get('x', 0))
+    timestamp = float(data.get('y', 0))  # Timestamp reçu
+    try:
+        detection = int(data.get('detection', 0))
+    except OverflowError:  # JSON 1e400 is decoded as infinity
+        raise ValueError("detection is out of range")
+    if not x_val.is_integer():
+        raise InvalidCardError("Invalid card identifier")
+    return validate_reading(int(x_val), data.get('site'), detection, timestamp)
+
+def parse_frame(frame):
+    """Validate one decoded binary (card_id, detection, timestamp_ms) reading, like parse_detection"""
+    if isinstance(frame, Exception):
+        raise frame
+    card_id, detection, timestamp = frame
+    # bool is an int subclass: a MessagePack true must not become card 1
+    if isinstance(card_id, bool) or not isinstance(card_id, int):
+        raise InvalidCardError("Invalid card identifier")
+    if isinstance(detection, bool) or not isinstance(detection, int):
+        raise ValueError("detection must be an integer")
+    if isinstance(timestamp, bool) or not isinstance(timestamp, (int, float)):
+        raise ValueError("timestamp_ms must be a number")
+    return validate_reading(card_id, None, detection, timestamp)
+
+def validate_reading(card_id, site, detection, timestamp):
+    """Check a decoded reading against the card registry and the retention window"""
+    if not 1 <= card_id <= MAX_INT64:
+        raise InvalidCardError("Invalid card identifier")
+    if not AUTO_REGISTER_CARDS and card_id not in card_registry:
+        raise InvalidCardError("Invalid card identifier")
+    if site is not None and not isinstance(site, str):
+        raise ValueError("site must be a string")
+    if not -MAX_INT64 - 1 <= detection <= MAX_INT64:
+        raise ValueError("detection is out of range")
+    # NaN fails both comparisons
+    if not MIN_TIMESTAMP_MS <= timestamp <= MAX_TIMESTAMP_MS:
+        raise ValueError("Timestamp is out of range")
+    if timestamp < retention_watermark_ms:
+        raise ValueError("Reading is older than the retention window")
+    formatted_date = convert_timestamp_to_datetime(timestamp)
+    return card_id, site, detection, timestamp, formatted_date
+
+EPOCH_FORMATTED = "01/01/1970 00:00:00"
+
+class CardState:
+    """Latest reading of one card, the authoritative state served by /get_detection"""
+    __slots__ = ('card_id', 'site', 'detection', 'timestamp_ms', 'formatted_date')
+
+    def __init__(self, card_id, site=None):
+        self.card_id = card_id
+        self.site = site
+        self.reset()
+
+    def reset(self):
+        self.detection = 0
+        self.timestamp_ms = None
+        self.formatted_date = EPOCH_FORMATTED
+
+    def to_dict(self):
+        return {"detection": self.detection, "x": float(self.card_id), "y": self.formatted_date}
+
+# card_id -> CardState for O(1) lookup, plus sorted id lists for stable pagination.
+# Hydrated from the database at startup and kept current by the ingest path.
+card_registry = {}
+sorted_card_ids = []
+site_card_ids = {}
+registry_lock = threading.Lock()
+
+def _register_card_locked(card_id, site=None):
+    """Register a card or move it to a new site; returns (state, changed). Needs registry_lock."""
+    state = card_registry.get(card_id)
+    if state is None:
+        state = card_registry[card_id] = CardState(card_id, site)
+        bisect.insort(sorted_card_ids, card_id)
+        if site:
+            bisect.insort(site_card_ids.setdefault(site, []), card_id)
+        return state, True
+    if site and site != state.site:
+        if state.site:
+            site_card_ids[state.site].remove(card_id)
+        bisect.insort(site_card_ids.setdefault(site, []), card_id)
+        state.site = site
+        return state, True
+    return state, False
+
+def record_reading(card_id, site, detection, timestamp_ms, formatted_date):
+    """Apply a reading to its card's state if it is the newest one seen; returns (state, registry_changed)"""
+    with registry_lock:
+        state, changed = _register_card_locked(card_id, site)
+        # Strictly newer: a retransmission at the same timestamp does not replace the stored reading
+        if state.timestamp_ms is None or timestamp_ms > state.timestamp_ms:
+            state.detection = detection
+            state.timestamp_ms = timestamp_ms
+            state.formatted_date = formatted_date
+    bump_data_version()
+    return state, changed
+
+def persist_cards(states):
+    """Save newly registered cards (and site changes) to the cards table"""
+    if not states:
+        return
+    try:
+        with db_connection() as conn:
+            with conn:
+                conn.executemany('''
+                    INSERT INTO cards (card_id, site) VALUES (?, ?)
+                    ON CONFLICT (card_id) DO UPDATE SET site = excluded.site
+                ''', [(state.card_id, state.site) for state in states])
+    except Exception as e:
+        logging.error(f"Error saving card registry: {e}")
+
+def hydrate_latest_cache():
+    """Load the card registry and the latest reading of every card from the database"""
+    try:
+        with db_connection() as conn:
+            registered = conn.execute("SELECT card_id, site FROM cards").fetchall()
+            results = conn.execute("SELECT card_id, detection, datetime_formatted, timestamp_ms FROM latest_state").fetchall()
+    except Exception as e:
+        logging.error(f"Error loading latest detections from DB: {e}")
+        return False
+    
+    new_cards = []
+    with registry_lock:
+        card_registry.clear()
+        sorted_card_ids.clear()
+        site_card_ids.clear()
+        for card_id, site in registered:
+            _register_card_locked(card_id, site)
+        for card_id in DEFAULT_CARDS:
+            state, changed = _register_card_locked(card_id)
+            if changed:
+                new_cards.append(state)
+        for card_id, detection, datetime_formatted, timestamp_ms in results:
+            state, changed = _register_card_locked(card_id)
+            if changed:
+                new_cards.append(state)
+            state.detection = detection
+            state.timestamp_ms = timestamp_ms
+            state.formatted_date = datetime_formatted
+    persist_cards(new_cards)
+    
+    logging.info(f"Card registry loaded: {len(card_registry)} cards, {len(results)} with readings")
+    return True
+
+_shared_state_lock = threading.Lock()
+_shared_state_conn = None
+_shared_state = {"data_version": None, "seq": 0, "rows": 0, "checked": 0.0, "reading": False}
+
+def _read_shared_state():
+    """Return (cards, latest_state rows changed since the last read, reset) when the database changed"""
+    global _shared_state_conn
+    if _shared_state_conn is None:
+        _shared_state_conn = open_connection()
+    conn = _shared_state_conn
+    # data_version changes when another connection commits; one read transaction keeps the three reads consistent
+    data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+    if data_version == _shared_state["data_version"]:
+        return None
+    with conn:
+        conn.execute("BEGIN")
+        row_count = conn.execute("SELECT COUNT(*) FROM latest_state").fetchone()[0]
+        reset = row_count < _shared_state["rows"]  # /empty_database ran in another worker
+        cards = conn.execute("SELECT card_id, site FROM cards").fetchall()
+        rows = conn.execute('''
+            SELECT seq, card_id, detection, datetime_formatted, timestamp_ms FROM latest_state
+            WHERE seq > ? ORDER BY seq
+        ''', (0 if reset else _shared_state["seq"],)).fetchall()
+        load_retention_watermark(conn)
+    _shared_state.update(data_version=data_version, rows=row_count)
+    if rows:
+        _shared_state["seq"] = rows[-1][0]
+    return cards, rows, reset
+
+def sync_shared_state():
+    """Apply the card states written by the other worker processes, at most every SHARED_STATE_REFRESH_MS"""
+    # The lock is native even in gevent mode: hold it only to claim the read, never across
+    # run_db(), which yields to the event loop while other greenlets wait on the lock
+    with _shared_state_lock:
+        now = time.monotonic()
+        if _shared_state["reading"] or now - _shared_state["checked"] < SHARED_STATE_REFRESH_MS / 1000:
+            return
+        _shared_state["checked"] = now
+        _shared_state["reading"] = True
+    try:
+        changes = run_db(_read_shared_state)
+    finally:
+        with _shared_state_lock:
+            _shared_state["reading"] = False
+    if changes is None:
+        return
+    cards, rows, reset = changes
+    if reset:
+        clear_recent_deltas()
+    with registry_lock:
+        if reset:
+            for state in card_registry.values():
+                state.reset()
+        for card_id, site in cards:
+            _register_card_locked(card_id, site)
+        for _, card_id, detection, datetime_formatted, timestamp_ms in rows:
+            state, _ = _register_card_locked(card_id)
+            if state.timestamp_ms is None or timestamp_ms >= state.timestamp_ms:
+                state.detection = detection
+                state.timestamp_ms = timestamp_ms
+                state.formatted_date = datetime_formatted
+    bump_data_version()
+
+def filtered_card_ids():
+    """Return the sorted registered card ids matching the cards/card_id/site query filters, or None"""
+    ids = request.args.get('cards') or request.args.get('card_id')
+    site = request.args.get('site')
+    if ids:
+        requested = {int(v) for v in ids.split(',') if v.strip()}
+        with registry_lock:
+            card_ids = sorted(card_id for card_id in requested if card_id in card_registry)
+            if site:
+                card_ids = [card_id for card_id in card_ids if card_registry[card_id].site == site]
+        return card_ids
+    if site:
+        with registry_lock:
+            return list(site_card_ids.get(site, []))
+    return None
+
+def parse_pagination():
+    """Return (limit, offset) from the query string, capped at MAX_PAGE_SIZE"""
+    limit = min(int(request.args.get('limit', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+    offset = int(request.args.get('offset', 0))
+    if limit < 0 or offset < 0:
+        raise ValueError("limit and offset must be positive")
+    return limit, offset
+
+def select_cards():
+    """Return (page of card ids, total matching cards) for the card filters and limit/offset"""
+    limit, offset = parse_pagination()
+    card_ids = filtered_card_ids()
+    if card_ids is not None:
+        return card_ids[offset:offset + limit], len(card_ids)
+    with registry_lock:
+        return sorted_card_ids[offset:offset + limit], len(sorted_card_ids)
+
+def card_snapshot(card_ids):
+    """Return the latest reading of the given registered cards"""
+    with registry_lock:
+        return [card_registry[card_id].to_dict() for card_id in card_ids if card_id in card_registry]
+
+# Every delta carries a sequence number so clients can order them and drop the
+# duplicates they get when subscribed to both a card and its site
+# With several workers each one takes every WORKERS-th number, so seq stays unique
+emit_seq = int(WORKER_INDEX or 0) + 1 - WORKERS
+_emit_lock = threading.Lock()
+_pending_deltas = {}
+_coalescer_started = False
+
+# Ring buffer of the deltas this process delivered, in delivery order. A resume looks up
+# the client's last seq in it and replays what follows. The stream id changes on every
+# restart, because seq numbers start over.
+DELTA_STREAM_ID = f"{os.getpid():x}.{time.time_ns():x}"
+recent_deltas = deque(maxlen=DELTA_BUFFER_SIZE)
+_recent_deltas_lock = threading.Lock()
+
+def record_deltas(deltas):
+    """Append delivered deltas to the replay buffer"""
+    with _recent_deltas_lock:
+        recent_deltas.extend(deltas)
+
+def clear_recent_deltas():
+    """Drop the replay buffer: after a reset, old deltas no longer describe the cards"""
+    with _recent_deltas_lock:
+        recent_deltas.clear()
+
+def newest_delta_seq():
+    """Seq of the last delta delivered by this process, the position a client resumes from"""
+    with _recent_deltas_lock:
+        return recent_deltas[-1]["seq"] if recent_deltas else None
+
+def deltas_since(last_seq):
+    """Return (deltas delivered after the one numbered last_seq, seq of the newest delta),
+    with None instead of the list when last_seq is no longer in the buffer"""
+    with _recent_deltas_lock:
+        buffered = list(recent_deltas)
+    newest = buffered[-1]["seq"] if buffered else None
+    # Scan from the newest: a client that was briefly away is near the end
+    for index in range(len(buffered) - 1, -1, -1):
+        if buffered[index]["seq"] == last_seq:
+            return buffered[index + 1:], newest
+    return None, newest
+
+def make_delta(state):
+    """Build the delta event payload for one card, tagged with the next sequence number"""
+    global emit_seq
+    with _emit_lock:
+        emit_seq += WORKERS
+        return {"seq": emit_seq, "card_id": state.card_id, "site": state.site, **state.to_dict()}
+
+def _room_is_active(room):
+    """True when at least one client of this process is in the room, or any process may have one"""
+    if MESSAGE_QUEUE:
+        return True
+    return bool(socketio.server.manager.rooms.get('/', {}).get(room))
+
+def emit_deltas(deltas):
+    """Send deltas to the 'all' room and to each card and site room, one emit per room"""
+    # With a message queue the relay records the deltas when it delivers them
+    if not MESSAGE_QUEUE:
+        record_deltas(deltas)
+    rooms = {}
+    for delta in deltas:
+        rooms.setdefault(f"card:{delta['card_id']}", []).append(delta)
+        if delta["site"]:
+            rooms.setdefault(f"site:{delta['site']}", []).append(delta)
+    if _room_is_active('all'):
+        socketio.emit('detection_delta', deltas, to='all')
+        SOCKETIO_EMITS.inc(('detection_delta',))
+    for room, room_deltas in rooms.items():
+        if _room_is_active(room):
+            socketio.emit('detection_delta', room_deltas, to=room)
+            SOCKETIO_EMITS.inc(('detection_delta',))
+    SOCKETIO_DELTAS.inc(amount=len(deltas))
+
+def _coalesce_loop():
+    """Flush the deltas merged during each coalescing window"""
+    global _pending_deltas
+    while True:
+        socketio.sleep(EMIT_COALESCE_MS / 1000)
+        with _emit_lock:
+            deltas, _pending_deltas = _pending_deltas, {}
+        if deltas:
+            emit_deltas(sorted(deltas.values(), key=lambda delta: delta["seq"]))
+
+def publish_updates(states):
+    """Broadcast the new state of the updated cards as delta events"""
+    global _coalescer_started
+    deltas = [make_delta(state) for state in states]
+    if EMIT_COALESCE_MS <= 0:
+        emit_deltas(deltas)
+        return
+    with _emit_lock:
+        # Only the newest delta of each card survives the window
+        for delta in deltas:
+            _pending_deltas[delta["card_id"]] = delta
+        if not _coalescer_started:
+            _coalescer_started = True
+            socketio.start_background_task(_coalesce_loop)
+
+def insert_readings(conn, readings):
+    """Insert readings and update the latest state and rollups with the new ones; returns a 'new' flag per reading"""
+    flags = storage.insert(conn, readings)
+    inserted = [reading for reading, new in zip(readings, flags) if new]
+    conn.executemany(UPSERT_LATEST_STATE_SQL, inserted)
+    apply_rollups(conn, inserted)
+    return flags
+
+def save_detections_batch_to_db(readings):
+    """Save a list of (card_id, detection, timestamp_ms, formatted_date) rows in a single transaction.
+
+    Returns a 'new' flag per reading (False for a duplicate), or None when the write failed.
+    """
+    try:
+        with db_connection() as conn:
+            with db_timer('insert'), storage.transaction():
+                flags = insert_readings(conn, readings)
+            with db_timer('commit'):
+                conn.commit()
+        if any(flags):  # a batch of retransmissions changes nothing
+            bump_data_version()
+
+        if log_hot_path():
+            logging.info(f"Saved batch to DB - {len(readings)} readings, {flags.count(False)} duplicates")
+        return flags
+    except Exception as e:
+        logging.error(f"Database batch error: {e}")
+        return None
+
+# The writer is a native thread. gevent patches the queue module even with thread=False,
+# and its queues cannot block a native thread, so take the standard one.
+if ASYNC_MODE == 'gevent':
+    ingest_queue = monkey.get_original('queue', 'Queue')(maxsize=WRITE_BEHIND_QUEUE_SIZE)
+else:
+    ingest_queue = queue.Queue(maxsize=WRITE_BEHIND_QUEUE_SIZE)
+_enqueue_lock = threading.Lock()
+_writer_thread = None
+_WRITER_STOP = object()
+
+def enqueue_readings(readings):
+    """Queue readings for the write-behind writer; returns False when the queue cannot take them all"""
+    with _enqueue_lock:
+        # Only the writer removes items, so free space can only grow after this check
+        if WRITE_BEHIND_QUEUE_SIZE - ingest_queue.qsize() < len(readings):
+            return False
+        for reading in readings:
+            ingest_queue.put_nowait(reading)
+    return True
+
+def write_behind_worker():
+    """Drain the ingest queue and write readings in group commits"""
+    stopping = False
+    while not stopping:
+        item = ingest_queue.get()
+        if item is _WRITER_STOP:
+            break
+        batch = [item]
+        deadline = time.monotonic() + WRITE_BEHIND_FLUSH_INTERVAL
+        while len(batch) < WRITE_BEHIND_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            try:
+                item = ingest_queue.get(timeout=remaining) if remaining > 0 else ingest_queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _WRITER_STOP:
+                stopping = True
+                break
+            batch.append(item)
+
+        if save_detections_batch_to_db(batch) is None:
+            # One bad reading fails the group commit: retry one by one so only that reading is lost
+            logging.error(f"Write-behind flush failed, retrying {len(batch)} readings one by one")
+            for reading in batch:
+                if save_detection_to_db(*reading) is None:
+                    logging.error(f"Write-behind dropped reading {reading}")
+                    INGESTED_READINGS.inc(('dropped',))
+
+def start_write_behind():
+    """Start the write-behind writer thread"""
+    global _writer_thread
+    if _writer_thread is None:
+        _writer_thread = threading.Thread(target=write_behind_worker, name="write-behind", daemon=True)
+        _writer_thread.start()
+        atexit.register(stop_write_behind)
+        logging.info(f"Write-behind ingest enabled (queue={WRITE_BEHIND_QUEUE_SIZE}, "
+                     f"batch={WRITE_BEHIND_BATCH_SIZE}, interval={WRITE_BEHIND_FLUSH_INTERVAL}s)")
+
+def stop_write_behind():
+    """Flush everything still queued and stop the writer thread"""
+    global _writer_thread
+    if _writer_thread is not None:
+        # Blocking put: the stop marker goes behind every reading already queued
+        ingest_queue.put(_WRITER_STOP)
+        _writer_thread.join()
+        _writer_thread = None
+        logging.info("Write-behind queue flushed")
+
 def save_detection_to_db(card_id, detection, timestamp_ms, formatted_date):
-    """Save detection data to SQLite database"""
+    """Save detection data to SQLite database; returns True if new, False for a duplicate, None on error"""
     try:
-        # Debug: Log current working directory and database path
-        current_dir = os.getcwd()
-        logging.info(f"Current working directory: {current_dir}")
-        logging.info(f"Attempting to write to database: {DB_NAME}")
-        
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO detections (card_id, detection, timestamp_ms, datetime_formatted)
-            VALUES (?, ?, ?, ?)
-        ''', (card_id, detection, timestamp_ms, formatted_date))
-        
-        conn.commit()
-        conn.close()
-        
-        # IMMEDIATE verification after insert
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM detections")
-        count_after_insert = cursor.fetchone()[0]
-        cursor.execute("SELECT * FROM detections WHERE card_id = ? ORDER BY created_at DESC LIMIT 1", (card_id,))
-        last_inserted = cursor.fetchone()
-        conn.close()
-        
-        logging.info(f"Saved to DB - Card: {card_id}, Detection: {detection}, Time: {formatted_date}")
-        logging.info(f"Total records after insert: {count_after_insert}")
-        logging.info(f"Last inserted record: {last_inserted}")
-        
-        # Check file metadata
-        if os.path.exists(DB_NAME):
-            file_size = os.path.getsize(DB_NAME)
-            mod_time = os.path.getmtime(DB_NAME)
-            logging.info(f"Database file size after insert: {file_size} bytes, modified: {mod_time}")
+        with db_connection() as conn:
+            with db_timer('insert'), storage.transaction():
+                [new] = insert_readings(conn, [(card_id, detection, timestamp_ms, formatted_date)])
+            
+            with db_timer('commit'):
+                conn.commit()
+            if new:  # a retransmission changes nothing
+                bump_data_version()
+            
+            if log_hot_path():
+                # Verification after insert, only when detailed logging is on
+                count_after_insert = storage.count(conn)
+                last_inserted = list(storage.card_readings(conn, card_id, timestamp_ms, timestamp_ms + 1))
+                
+                logging.info(f"Saved to DB - Card: {card_id}, Detection: {detection}, Time: {formatted_date}")
+                logging.info(f"Total records after insert: {count_after_insert}")
+                logging.info(f"Last inserted record: {last_inserted}")
         
-        return True
+        return new
     except Exception as e:
         logging.error(f"Database error: {e}")
         logging.error(f"Failed to save - Card: {card_id}, Detection: {detection}")
-        return False
+        return None
+
+# Binary ingest for constrained devices. A frame is 16 bytes, little-endian: card id
+# (uint32), cumulative detection counter (uint32), timestamp in ms (int64). A body holds
+# one frame or several back to back.
+FRAME_MIMETYPE = 'application/x-detection-frame'
+DETECTION_FRAME = struct.Struct('<IIq')
+# MessagePack: one [card_id, detection, timestamp_ms] array, or an array of them
+MSGPACK_MIMETYPES = ('application/msgpack', 'application/x-msgpack')
+
+def read_binary_readings():
+    """Decode a struct-frame or MessagePack body into (card_id, detection, timestamp_ms) tuples.
+
+    Returns None when the body is not binary. Malformed MessagePack items are returned as
+    ValueError instances so batches can report them per item.
+    """
+    if request.mimetype == FRAME_MIMETYPE:
+        body = request.get_data(cache=False)
+        if not body or len(body) % DETECTION_FRAME.size:
+            raise ValueError(f"Body must be a sequence of {DETECTION_FRAME.size}-byte frames")
+        # iter_unpack decodes every frame in C, without building per-field JSON objects
+        return list(DETECTION_FRAME.iter_unpack(body))
+    if request.mimetype in MSGPACK_MIMETYPES:
+        if msgpack is None:
+            raise UnsupportedMediaType("MessagePack support is not installed")
+        data = msgpack.unpackb(request.get_data(cache=False), use_list=False)
+        if not isinstance(data, tuple) or not data:
+            raise ValueError("MessagePack body must be a non-empty array")
+        if not isinstance(data[0], tuple):
+            data = (data,)  # a single reading
+        return [item if isinstance(item, tuple) and len(item) == 3
+                else ValueError("Reading must be [card_id, detection, timestamp_ms]") for item in data]
+    return None
+
 @app.route('/send_detection', methods=['POST'])
 def receive_detection():
-    global detection_data
     try:
-        # Récupérer les données envoyées
-        data = request.get_json()
-        x_val = float(data.get('x', 0))
-        timestamp = float(data.get('y', 0))  # Timestamp reçu
-        detection = data.get('detection', 0)
-        
-        # Convertir le timestamp en format lisible
-        formatted_date = convert_timestamp_to_datetime(timestamp)
-        
-        # Identifier la carte en fonction de la valeur de x
-        if x_val == 1:  # Carte 1
-            detection_data[0] = {
-                "detection": detection,
-                "x": x_val,
-                "y": formatted_date  # Stocker la date formatée au lieu du timestamp
-            }
-            # Set the same y value for detection 2
-            detection_data[1]["y"] = formatted_date
-            # Save to database
-            save_detection_to_db(1, detection, timestamp, formatted_date)
-            
-        elif x_val == 2:  # Carte 2
-            detection_data[1] = {
-                "detection": detection,
-                "x": x_val,
-                "y": formatted_date  # Stocker la date formatée au lieu du timestamp
-            }
-            # Set the same y value for detection 1
-            detection_data[0]["y"] = formatted_date
-            # Save to database
-            save_detection_to_db(2, detection, timestamp, formatted_date)
-            
+        # Récupérer les données envoyées : JSON, ou une trame binaire unique
+        frames = read_binary_readings()
+        if frames is None:
+            card_id, site, detection, timestamp, formatted_date = parse_detection(request.get_json())
+        elif len(frames) == 1:
+            card_id, site, detection, timestamp, formatted_date = parse_frame(frames[0])
         else:
-            return jsonify({"error": "Invalid card identifier"}), 400
+            raise ValueError("Send several frames to /send_detections")
+
+        # Enregistrer en base (ou en file d'attente) puis mettre à jour l'état de la carte.
+        # new reste None en write-behind : le doublon n'est détecté qu'à l'écriture.
+        new = None
+        if WRITE_BEHIND:
+            if not enqueue_readings([(card_id, detection, timestamp, formatted_date)]):
+                return jsonify({"error": "Ingest queue full, retry later"}), 429
+        else:
+            new = run_db(save_detection_to_db, card_id, detection, timestamp, formatted_date)
+            if new is None:
+                return jsonify({"error": "Error saving data"}), 500
+        if new is False:
+            # Nothing was stored: leave the card state, the response cache and the ETags alone
+            with registry_lock:
+                state, registry_changed = _register_card_locked(card_id)
+            if registry_changed:
+                bump_data_version()
+        else:
+            state, registry_changed = record_reading(card_id, site, detection, timestamp, formatted_date)
+        if registry_changed:
+            run_db(persist_cards, [state])
 
         # Logging des données reçues
-        logging.info(f"Received data - x: {x_val}, y: {formatted_date}, detection: {detection}")
-        logging.info(f"Updated detection data: {detection_data}")
+        INGESTED_READINGS.inc(('duplicate',) if new is False else ('accepted',))
+        if log_hot_path():
+            logging.info(f"Received data - card: {card_id}, y: {formatted_date}, detection: {detection}, new: {new}")
         
-        # Émission de l'événement Socket.IO (without broadcast parameter)
-        socketio.emit('update_detection', detection_data)
+        # Émission du delta Socket.IO pour cette carte (rien à diffuser pour un doublon)
+        if new is not False:
+            publish_updates([state])
         
         return jsonify({
-            "message": "Data updated successfully",
-            "data": detection_data
+            "message": "Data updated successfully" if new is not False else "Duplicate reading ignored",
+            "new": new,
+            "data": [state.to_dict()]
         }), 200
         
+    except InvalidCardError:
+        INGESTED_READINGS.inc(('rejected',))
+        return jsonify({"error": "Invalid card identifier"}), 400
+    except UnsupportedMediaType as e:
+        return jsonify({"error": e.description}), 415
     except ValueError as e:
+        INGESTED_READINGS.inc(('rejected',))
         logging.error(f"ValueError: {e}")
         return jsonify({"error": "Invalid x or y values"}), 400
     except Exception as e:
@@ -258,229 +1771,521 @@ def receive_detection():
         return jsonify({"error": "Error processing data"}), 400
 
 
+def read_batch_payload():
+    """Return (readings, parser) for a body posted as a JSON array, NDJSON or binary frames.
+
+    Items that could not be decoded are ValueError instances, reported per item.
+    """
+    frames = read_binary_readings()
+    if frames is not None:
+        return frames, parse_frame
+    body = request.get_data(cache=False, as_text=True)
+    if request.mimetype in ('application/x-ndjson', 'application/ndjson', 'application/jsonl'):
+        items = []
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                items.append(ValueError("Invalid JSON line"))
+        return items, parse_detection
+
+    data = json.loads(body)
+    if not isinstance(data, list):
+        raise ValueError("Batch body must be a JSON array")
+    return data, parse_detection
+
+@app.route('/send_detections', methods=['POST'])
+def receive_detections_batch():
+    """Ingest a batch of readings (JSON array or NDJSON) in a single transaction"""
+    try:
+        items, parse = read_batch_payload()
+    except UnsupportedMediaType as e:
+        return jsonify({"error": e.description}), 415
+    except ValueError as e:
+        logging.error(f"Invalid batch payload: {e}")
+        return jsonify({"error": "Invalid batch payload"}), 400
+
+    if len(items) > MAX_BATCH_SIZE:
+        return jsonify({"error": f"Batch too large (max {MAX_BATCH_SIZE} readings)"}), 413
+
+    # Validate the whole batch first, collecting per-item errors
+    readings = []
+    parsed = []
+    indexes = []
+    errors = []
+    for index, item in enumerate(items):
+        try:
+            if isinstance(item, Exception):
+                raise item
+            card_id, site, detection, timestamp, formatted_date = parse(item)
+        except (ValueError, TypeError) as e:
+            errors.append({"index": index, "error": str(e)})
+            continue
+        readings.append((card_id, detection, timestamp, formatted_date))
+        parsed.append((card_id, site, detection, timestamp, formatted_date))
+        indexes.append(index)
+
+    if not readings:
+        return jsonify({
+            "error": "No valid readings in batch",
+            "accepted": 0,
+            "rejected": len(errors),
+            "errors": errors
+        }), 400
+
+    # flags stays None in write-behind mode: duplicates are only found when the batch is written
+    flags = None
+    if WRITE_BEHIND:
+        if not enqueue_readings(readings):
+            return jsonify({"error": "Ingest queue full, retry later"}), 429
+    else:
+        flags = run_db(save_detections_batch_to_db, readings)
+        if flags is None:
+            return jsonify({"error": "Error saving batch"}), 500
+
+    updated = {}
+    new_cards = []
+    duplicates = []
+    for position, (card_id, site, detection, timestamp, formatted_date) in enumerate(parsed):
+        if flags is not None and not flags[position]:
+            duplicates.append(indexes[position])
+            continue
+        state, registry_changed = record_reading(card_id, site, detection, timestamp, formatted_date)
+        updated[card_id] = state
+        if registry_changed:
+            new_cards.append(state)
+    run_db(persist_cards, new_cards)
+
+    INGESTED_READINGS.inc(('accepted',), len(readings) - len(duplicates))
+    INGESTED_READINGS.inc(('duplicate',), len(duplicates))
+    INGESTED_READINGS.inc(('rejected',), len(errors))
+    if log_hot_path():
+        logging.info(f"Received batch - accepted: {len(readings)}, duplicates: {len(duplicates)}, rejected: {len(errors)}")
+
+    # One delta per updated card, sent as a single emit per room
+    publish_updates([updated[card_id] for card_id in sorted(updated)])
+    
+    return jsonify({
+        "message": "Batch processed",
+        "accepted": len(readings),
+        "rejected": len(errors),
+        "errors": errors,
+        # Indexes of the readings already stored (null when not known yet in write-behind mode)
+        "duplicates": duplicates if flags is not None else None,
+        "data": [updated[card_id].to_dict() for card_id in sorted(updated)]
+    }), 200
+
+
+# Latest row per card. The recursive CTE walks the distinct card ids through
+# idx_detections_card_ts, so the cost is one index seek per card instead of a table scan.
+LATEST_DETECTIONS_SQL = '''
+    WITH RECURSIVE cards(card_id) AS (
+        SELECT MIN(card_id) FROM detections
+        UNION ALL
+        SELECT (SELECT MIN(card_id) FROM detections WHERE card_id > cards.card_id)
+        FROM cards WHERE cards.card_id IS NOT NULL
+    )
+    SELECT 
+        d.card_id, 
+        d.detection, 
+        d.datetime_formatted,
+        d.timestamp_ms
+    FROM cards
+    JOIN detections d ON d.id = (
+        SELECT id FROM detections
+        WHERE card_id = cards.card_id
+        ORDER BY timestamp_ms DESC
+        LIMIT 1
+    )
+    ORDER BY d.card_id
+'''
+
+def date_to_ms(date_str):
+    """Convert a YYYY-MM-DD date to the UTC epoch milliseconds of its midnight"""
+    dt = datetime.strptime(date_str, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+    return int(dt.timestamp() * 1000)
+
+def build_hourly_query(date=None, card_ids=None):
+    """Build the /detections_per_hour query over the hourly rollups, filtering on hour_ms bounds"""
+    query = '''
+        SELECT 
+            card_id,
+            (hour_ms / 3600000) % 24 as hour,
+            SUM(increment) as increment
+        FROM detections_hourly
+        WHERE 1=1
+    '''
+    params = []
+    
+    if date:
+        start_ms = date_to_ms(date)
+        query += " AND hour_ms >= ? AND hour_ms < ?"
+        params.extend([start_ms, start_ms + DAY_MS])
+    
+    if card_ids is not None:
+        query += f" AND card_id IN ({','.join('?' * len(card_ids))})"
+        params.extend(card_ids)
+    
+    query += " GROUP BY card_id, hour"
+    return query, params
+
+def build_daily_query(start_date=None, end_date=None, card_ids=None, limit=None, offset=0):
+    """Build the /detections_per_day query over the daily rollups, filtering on day_ms bounds"""
+    query = '''
+        SELECT 
+            DATE(day_ms / 1000, 'unixepoch') as date,
+            card_id,
+            detections_count,
+            total_records
+        FROM detections_daily
+        WHERE 1=1
+    '''
+    params = []
+    
+    if start_date:
+        query += " AND day_ms >= ?"
+        params.append(date_to_ms(start_date))
+    
+    if end_date:
+        # end_date is inclusive
+        query += " AND day_ms <= ?"
+        params.append(date_to_ms(end_date))
+        
+    if card_ids is not None:
+        query += f" AND card_id IN ({','.join('?' * len(card_ids))})"
+        params.extend(card_ids)
+    
+    query += " ORDER BY day_ms DESC, card_id"
+    if limit is not None:
+        query += " LIMIT ? OFFSET ?"
+        params.extend([limit, offset])
+    return query, params
+
+HISTOGRAM_BUCKETS = {'1m': 60000, '5m': 300000, '15m': 900000, '1h': HOUR_MS, '1d': DAY_MS}
+QUARTER_HOUR_MS = 900000
+
+def build_histogram_query(start_ms, end_ms, slot_ms, card_ids):
+    """Build the query summing per-card increments into UTC slots of slot_ms over [start_ms, end_ms).
+
+    Increments follow the rollup rules in one pass over the (card_id, timestamp_ms) index:
+    LAG gives the previous reading of the card, the first reading of a UTC day counts
+    as-is and a counter reset counts the current value.
+    Hour slots are read from the hourly rollups, which also cover archived days.
+    """
+    card_filter = f"card_id IN ({','.join('?' * len(card_ids))})"
+    if slot_ms == HOUR_MS:
+        query = f'''
+            SELECT card_id, hour_ms, increment FROM detections_hourly
+            WHERE hour_ms >= ? AND hour_ms < ? AND {card_filter}
+        '''
+        return query, [start_ms, end_ms, *card_ids]
+    
+    query = f'''
+        WITH readings AS (
+            SELECT card_id, detection, timestamp_ms,
+                   LAG(timestamp_ms) OVER w AS prev_ts,
+                   LAG(detection) OVER w AS prev_detection
+            FROM detections
+            WHERE timestamp_ms >= ? AND timestamp_ms < ? AND {card_filter}
+            WINDOW w AS (PARTITION BY card_id ORDER BY timestamp_ms)
+        )
+        SELECT card_id, timestamp_ms - timestamp_ms % ? AS slot_ms,
+               SUM(CASE
+                   WHEN prev_ts IS NULL OR prev_ts / {DAY_MS} < timestamp_ms / {DAY_MS} THEN detection
+                   WHEN detection < prev_detection THEN detection
+                   ELSE detection - prev_detection
+               END) AS increment
+        FROM readings
+        WHERE timestamp_ms >= ?
+        GROUP BY card_id, slot_ms
+    '''
+    # Start reading at UTC midnight: the first reading of the day counts differently
+    return query, [start_ms - start_ms % DAY_MS, end_ms, *card_ids, slot_ms, start_ms]
+
+def parse_histogram_time(value, tz, end=False):
+    """Parse an ISO date or datetime (local to tz when it has no offset) to epoch ms.
+
+    A date-only end covers the whole day.
+    """
+    dt = datetime.fromisoformat(value)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=tz)
+    if end and len(value) == 10:
+        dt = (dt.replace(tzinfo=None) + timedelta(days=1)).replace(tzinfo=tz)
+    return int(dt.timestamp() * 1000)
+
+def local_bucket_ms(timestamp_ms, bucket, tz):
+    """Return the epoch ms at which the local-time bucket containing timestamp_ms starts"""
+    local = datetime.fromtimestamp(timestamp_ms / 1000, tz=tz)
+    if bucket == '1d':
+        start = local.replace(hour=0, minute=0, second=0, microsecond=0, fold=0)
+    else:
+        minutes = HISTOGRAM_BUCKETS[bucket] // 60000
+        start = local.replace(minute=local.minute - local.minute % minutes if minutes < 60 else 0,
+                              second=0, microsecond=0)
+    return int(start.timestamp() * 1000)
+
+def local_bucket_starts(start_ms, end_ms, bucket, tz):
+    """Return the start of every local bucket from the one holding start_ms up to end_ms, in order.
+
+    Steps one bucket width at a time, so the work grows with the number of buckets, which
+    the route caps at MAX_HISTOGRAM_BUCKETS. Around an offset change, where a bucket is
+    longer or shorter than its width, it steps in slots of at most 15 minutes instead.
+    """
+    width = HISTOGRAM_BUCKETS[bucket]
+    step = min(width, QUARTER_HOUR_MS)
+    starts = []
+    bucket_ms = local_bucket_ms(start_ms, bucket, tz)
+    while bucket_ms < end_ms:
+        starts.append(bucket_ms)
+        next_ms = local_bucket_ms(bucket_ms + width, bucket, tz)
+        if next_ms <= bucket_ms or local_bucket_ms(next_ms - 1, bucket, tz) != bucket_ms:
+            probe = bucket_ms + step
+            next_ms = local_bucket_ms(probe, bucket, tz)
+            while next_ms == bucket_ms:
+                probe += step
+                next_ms = local_bucket_ms(probe, bucket, tz)
+        bucket_ms = next_ms
+    return starts
+
+def histogram_slot_ms(bucket, tz, bucket_starts, end_ms):
+    """Pick the UTC slot width to aggregate in SQL before folding slots into local buckets.
+
+    Every timezone offset is a multiple of 15 minutes, so 15-minute slots fold into any
+    local bucket. Hour slots, read from the rollups, are enough when the offset is a
+    whole number of hours throughout the range: it is checked on both sides of every
+    bucket boundary, so an offset change in the middle of the range is seen too.
+    """
+    width = HISTOGRAM_BUCKETS[bucket]
+    if width <= QUARTER_HOUR_MS:
+        return width
+    instants = {*bucket_starts, *(start - 1 for start in bucket_starts[1:]), end_ms - 1}
+    for ms in instants:
+        if datetime.fromtimestamp(ms / 1000, tz=tz).utcoffset().total_seconds() % 3600:
+            return QUARTER_HOUR_MS
+    return HOUR_MS
+
+def fold_histogram(start_ms, end_ms, slot_ms, card_ids, bucket_starts):
+    """Sum the per-card slot increments over [start_ms, end_ms) into the local buckets;
+    returns {card_id: [increment per bucket]}. Blocking: call through run_db."""
+    counts = {card_id: [0] * len(bucket_starts) for card_id in card_ids}
+    for card_id, slot, increment in storage.histogram(start_ms, end_ms, slot_ms, card_ids):
+        if start_ms <= slot < end_ms:
+            # Slots never straddle a bucket boundary: the bucket is the last one starting at or before the slot
+            counts[card_id][bisect.bisect_right(bucket_starts, slot) - 1] += increment
+    return counts
+
+SCAN_CHECKED_TABLES = ('detections', 'd', 'detections_hourly', 'detections_daily')
+
+def explain_query_plan(query, params=()):
+    """Return the EXPLAIN QUERY PLAN detail lines for a query"""
+    with db_connection() as conn:
+        return [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + query, params).fetchall()]
+
+def find_full_scans():
+    """Return {query name: plan lines} for every endpoint query that scans the detections table"""
+    sample_date = '2024-01-01'
+    queries = {
+        "get_detection": (LATEST_DETECTIONS_SQL, ()),
+        "detections_per_hour?date": build_hourly_query(sample_date, [1, 2]),
+        "detections_per_hour?cards": build_hourly_query(card_ids=[1, 2]),
+        "detections_per_day?start_date&end_date": build_daily_query(sample_date, sample_date),
+        "detections_per_day?start_date&end_date&cards": build_daily_query(sample_date, sample_date, [1, 2]),
+        "detections_per_day?cards": build_daily_query(card_ids=[1, 2]),
+        "detections_histogram?bucket=5m": build_histogram_query(0, DAY_MS, 300000, [1, 2]),
+        "detections_histogram?bucket=1h": build_histogram_query(0, DAY_MS, HOUR_MS, [1, 2]),
+        "export_detections?start_date&end_date": build_export_query(0, DAY_MS),
+        "export_detections?after": build_export_query(after=(0, 0), limit=1000),
+        "export_detections?card_id": build_export_query(card_ids=[1]),
+    }
+    full_scans = {}
+    for name, (query, params) in queries.items():
+        plan = explain_query_plan(query, params)
+        # "SCAN detections" walks every row (or every index entry); SEARCH uses an index range.
+        # Scans of CTEs such as "SCAN cards" only walk the per-card list and are fine.
+        if any(line.startswith("SCAN ") and line.split()[1] in SCAN_CHECKED_TABLES for line in plan):
+            full_scans[name] = plan
+    return full_scans
+
+@app.cli.command('check-query-plans')
+def check_query_plans_command():
+    """Fail if an endpoint query plan falls back to a full table scan"""
+    full_scans = find_full_scans()
+    for name, plan in full_scans.items():
+        print(f"FULL SCAN in {name}:")
+        for line in plan:
+            print(f"    {line}")
+    if full_scans:
+        raise SystemExit(1)
+    print("All endpoint queries use an index")
+
+
+# Data version: bumped after every committed write and card state change. Cached responses
+# are keyed on it, so a new reading makes every cached response stale at once.
+data_version = 0
+_data_version_lock = threading.Lock()
+# Distinguishes ETags of this process from those of a previous run, whose versions restarted at 0
+_ETAG_EPOCH = f"{os.getpid():x}.{time.time_ns():x}"
+
+def bump_data_version():
+    global data_version
+    with _data_version_lock:
+        data_version += 1
+
+class ResponseCache:
+    """LRU cache of rendered responses keyed by (path, query string, data version)"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE)
+
+def cached_response(view):
+    """Serve a read endpoint from the response cache, with an ETag and 304 on If-None-Match.
+
+    Only 200 responses are cached. Views must depend on nothing but the query string and
+    the stored data.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        version = data_version
+        query = tuple(sorted(request.args.items(multi=True)))
+        key = (request.path, query, version)
+        etag = f"{_ETAG_EPOCH}.{version:x}.{zlib.crc32(repr(key[:2]).encode()):08x}"
+        
+        if request.if_none_match.contains(etag):
+            RESPONSE_CACHE_REQUESTS.inc(('not_modified',))
+            response = Response(status=304)
+        else:
+            entry = response_cache.get(key) if RESPONSE_CACHE_SIZE > 0 else None
+            if entry is not None:
+                RESPONSE_CACHE_REQUESTS.inc(('hit',))
+                body, mimetype, headers = entry
+                response = Response(body, mimetype=mimetype, headers=headers)
+            else:
+                RESPONSE_CACHE_REQUESTS.inc(('miss',))
+                response = app.make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                if RESPONSE_CACHE_SIZE > 0:
+                    headers = {name: value for name, value in response.headers.items() if name == 'X-Total-Count'}
+                    response_cache.put(key, (response.get_data(), response.mimetype, headers))
+        response.set_etag(etag)
+        # Clients may keep the response but must revalidate it on every poll
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    return wrapper
+
 @app.route('/get_detection', methods=['GET'])
+@cached_response
 def send_detection():
-    """Get the most recent detection data from database (latest cumulative values)"""
+    """Get the most recent detection data per card (latest cumulative values) from the in-memory cache.
+
+    Optional filters: cards=1,2,3 (or card_id), site, limit and offset. The total number of
+    matching cards is returned in the X-Total-Count header.
+    """
     try:
-        # Ensure database exists before querying
-        init_database()
-        
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        
-        # Get the most recent detection for each card (latest timestamp)
-        cursor.execute('''
-            SELECT 
-                card_id, 
-                detection, 
-                datetime_formatted,
-                timestamp_ms
-            FROM detections d1
-            WHERE timestamp_ms = (
-                SELECT MAX(timestamp_ms) 
-                FROM detections d2 
-                WHERE d2.card_id = d1.card_id
-            )
-            ORDER BY card_id
-        ''')
-        
-        results = cursor.fetchall()
-        conn.close()
-        
-        logging.info(f"Latest detection data from DB: {results}")
-        
-        # Initialize with default values for both cards
-        card_data = {
-            1: {"detection": "0", "x": 1.0, "y": "01/01/1970 00:00:00"}, 
-            2: {"detection": "0", "x": 2.0, "y": "01/01/1970 00:00:00"}
-        }
-        
-        # Update with actual latest values from database
-        for row in results:
-            card_id = row[0]
-            detection = str(row[1])  # Convert to string as required
-            datetime_formatted = row[2]
-            
-            card_data[card_id] = {
-                "detection": detection,
-                "x": float(card_id),
-                "y": datetime_formatted
-            }
-        
-        # Convert to list format (card 1 first, then card 2)
-        formatted_data = [
-            card_data[1],
-            card_data[2]
-        ]
-        
-        logging.info(f"Formatted response: {formatted_data}")
-        return jsonify(formatted_data)
-        
-    except Exception as e:
-        logging.error(f"Error getting detection data from DB: {e}")
-        # Return default structure if database error
-        return jsonify([
-            {"detection": "0", "x": 1.0, "y": "01/01/1970 00:00:00"},
-            {"detection": "0", "x": 2.0, "y": "01/01/1970 00:00:00"}
-        ])
+        card_ids, total = select_cards()
+    except ValueError:
+        return jsonify({"error": "Invalid cards, limit or offset"}), 400
+    
+    formatted_data = []
+    with registry_lock:
+        for card_id in card_ids:
+            card = card_registry[card_id].to_dict()
+            card["detection"] = str(card["detection"])  # Convert to string as required
+            formatted_data.append(card)
+    
+    response = jsonify(formatted_data)
+    response.headers['X-Total-Count'] = str(total)
+    return response
 
 @app.route('/detections_per_hour', methods=['GET'])
+@cached_response
 def get_detections_per_hour():
-    """Get detection count grouped by hour of the day (incremental differences between hours)"""
+    """Get detection count grouped by hour of the day (incremental differences between hours).
+
+    One "Trap <card_id>" column per card of the requested page; accepts the same
+    cards/site/limit/offset filters as /get_detection.
+    """
+    trap_names = {card_id: f"Trap {card_id}" for card_id in DEFAULT_CARDS}
     try:
-        # Ensure database exists before querying
-        init_database()
-        
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        
         # Get optional date filter from query parameters
         date = request.args.get('date')  # Format: YYYY-MM-DD
-        logging.info(f"Date filter requested: {date}")
-        
-        # Get all detections ordered by timestamp for each card
-        query = '''
-            SELECT 
-                card_id,
-                detection,
-                timestamp_ms,
-                strftime('%H', datetime(timestamp_ms/1000, 'unixepoch')) as hour,
-                DATE(datetime(timestamp_ms/1000, 'unixepoch')) as date
-            FROM detections
-            WHERE 1=1
-        '''
-        params = []
-        
-        if date:
-            query += " AND DATE(datetime(timestamp_ms/1000, 'unixepoch')) = ?"
-            params.append(date)
         
-        # Group by card_id, timestamp_ms to get unique readings per timestamp
-        query += " GROUP BY card_id, timestamp_ms ORDER BY card_id, timestamp_ms"
+        card_ids, total = select_cards()
+        trap_names = {card_id: f"Trap {card_id}" for card_id in card_ids}
         
-        logging.info(f"Executing query: {query} with params: {params}")
-        cursor.execute(query, params)
-        results = cursor.fetchall()
-        
-        logging.info(f"Raw data from database: {results}")
+        # Built even without cards so an invalid date is reported
+        query, params = build_hourly_query(date, card_ids)
+        results = []
+        if card_ids:
+            results = run_db(fetch_all, query, params)
         
         # Initialize hourly data
         hourly_data = {}
         for hour in range(24):
-            hourly_data[hour] = {"Trap 1": 0, "Trap 2": 0}
+            hourly_data[hour] = dict.fromkeys(trap_names.values(), 0)
         
-        # Process data for each card separately to calculate incremental differences
-        card_data = {1: [], 2: []}
-        for row in results:
-            card_id = row[0]
-            detection = row[1]
-            timestamp_ms = row[2]
-            hour = int(row[3])
-            card_data[card_id].append((detection, timestamp_ms, hour))
-        
-        # Calculate incremental differences for each card
-        for card_id in [1, 2]:
-            trap_name = f"Trap {card_id}"
-            data_points = card_data[card_id]
-            
-            logging.info(f"Processing {trap_name} with {len(data_points)} data points: {data_points}")
-            
-            for i in range(len(data_points)):
-                current_detection = data_points[i][0]
-                current_hour = data_points[i][2]
-                
-                if i == 0:
-                    # First reading: use the detection value as-is
-                    increment = current_detection
-                    logging.info(f"{trap_name} - First reading at hour {current_hour}: {current_detection} (using as increment: {increment})")
-                else:
-                    # Calculate difference from previous reading (cumulative logic)
-                    previous_detection = data_points[i-1][0]
-                    increment = current_detection - previous_detection
-                    logging.info(f"{trap_name} - Hour {current_hour}: current={current_detection}, previous={previous_detection}, increment={increment}")
-                
-                # Handle negative increments (sensor reset or error)
-                if increment < 0:
-                    logging.warning(f"{trap_name} - Negative increment detected: {increment}. Using current value instead.")
-                    increment = current_detection  # Use current value when sensor resets
-                
-                # Add increment to the hour
-                if card_id == 1:
-                    hourly_data[current_hour]["Trap 1"] += increment
-                elif card_id == 2:
-                    hourly_data[current_hour]["Trap 2"] += increment
-        
-        logging.info(f"Final hourly data: {hourly_data}")
+        # Increments are precomputed per card and hour by the rollups
+        for card_id, hour, increment in results:
+            hourly_data[hour][trap_names[card_id]] += increment
         
         # Format the response as requested
         result = []
         for hour in range(24):
             hour_str = f"{hour:02d}:00"
-            result.append({
-                "name": hour_str,
-                "Trap 1": hourly_data[hour]["Trap 1"],
-                "Trap 2": hourly_data[hour]["Trap 2"]
-            })
+            result.append({"name": hour_str, **hourly_data[hour]})
         
-        conn.close()
-        return jsonify(result)
+        response = jsonify(result)
+        response.headers['X-Total-Count'] = str(total)
+        return response
         
+    except ValueError as e:
+        logging.error(f"Invalid hourly detections filter: {e}")
+        return jsonify({"error": "Invalid date, card, limit or offset filter (dates use YYYY-MM-DD)"}), 400
     except Exception as e:
         logging.error(f"Error getting hourly detections: {e}")
         # Return default structure with all zeros if error
         result = []
         for hour in range(24):
             hour_str = f"{hour:02d}:00"
-            result.append({
-                "name": hour_str,
-                "Trap 1": 0,
-                "Trap 2": 0
-            })
+            result.append({"name": hour_str, **dict.fromkeys(trap_names.values(), 0)})
         return jsonify(result)
 
 
 @app.route('/detections_per_day', methods=['GET'])
+@cached_response
 def get_detections_per_day():
     """Get detection count grouped by day"""
     try:
-        # Ensure database exists before querying
-        init_database()
-        
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        
         # Get optional date filter from query parameters
         start_date = request.args.get('start_date')  # Format: YYYY-MM-DD
         end_date = request.args.get('end_date')      # Format: YYYY-MM-DD
-        card_id = request.args.get('card_id')        # Optional card filter
-        
-        query = '''
-            SELECT 
-                DATE(datetime(timestamp_ms/1000, 'unixepoch')) as date,
-                card_id,
-                COUNT(CASE WHEN detection = 1 THEN 1 END) as detections_count,
-                COUNT(*) as total_records
-            FROM detections
-            WHERE 1=1
-        '''
-        params = []
+        card_ids = filtered_card_ids()                # Optional cards/card_id/site filter
+        limit, offset = parse_pagination()
         
-        if start_date:
-            query += " AND DATE(datetime(timestamp_ms/1000, 'unixepoch')) >= ?"
-            params.append(start_date)
+        query, params = build_daily_query(start_date, end_date, card_ids, limit, offset)
         
-        if end_date:
-            query += " AND DATE(datetime(timestamp_ms/1000, 'unixepoch')) <= ?"
-            params.append(end_date)
-            
-        if card_id:
-            query += " AND card_id = ?"
-            params.append(int(card_id))
-        
-        query += " GROUP BY DATE(datetime(timestamp_ms/1000, 'unixepoch')), card_id ORDER BY date DESC"
-        
-        cursor.execute(query, params)
-        results = cursor.fetchall()
+        results = run_db(fetch_all, query, params)
         
         # Format results
         daily_data = []
@@ -492,28 +2297,598 @@ def get_detections_per_day():
                 "total_records": row[3]
             })
         
-        conn.close()
-        
         return jsonify({
             "daily_detections": daily_data,
-            "total_days": len(set([item["date"] for item in daily_data]))
+            "total_days": len(set([item["date"] for item in daily_data])),
+            "limit": limit,
+            "offset": offset
         }), 200
         
+    except ValueError as e:
+        logging.error(f"Invalid daily detections filter: {e}")
+        return jsonify({"error": "Invalid date, card, limit or offset filter (dates use YYYY-MM-DD)"}), 400
     except Exception as e:
         logging.error(f"Error getting daily detections: {e}")
         return jsonify({"error": "Error retrieving daily data"}), 500
 
+@app.route('/detections_histogram', methods=['GET'])
+def get_detections_histogram():
+    """Get per-card detection increments in buckets of 1m, 5m, 15m, 1h or 1d over a time range.
+
+    start and end are ISO dates or datetimes, in tz (an IANA name, UTC by default) when
+    they carry no offset; a date-only end includes that day. Buckets follow local time in
+    tz and every bucket of the range is returned, one "Trap <card_id>" column per card of
+    the requested page (same cards/site/limit/offset filters as /get_detection).
+    """
+    try:
+        tz = ZoneInfo(request.args.get('tz', 'UTC'))
+        bucket = request.args.get('bucket', '1h')
+        if bucket not in HISTOGRAM_BUCKETS:
+            raise ValueError(f"Unknown bucket {bucket}")
+        if not request.args.get('start'):
+            raise ValueError("start is required")
+        start_ms = local_bucket_ms(parse_histogram_time(request.args['start'], tz), bucket, tz)
+        if request.args.get('end'):
+            end_ms = parse_histogram_time(request.args['end'], tz, end=True)
+        else:
+            end_ms = int(time.time() * 1000)
+        if end_ms <= start_ms:
+            raise ValueError("end must be after start")
+        if (end_ms - start_ms) // HISTOGRAM_BUCKETS[bucket] > MAX_HISTOGRAM_BUCKETS:
+            raise ValueError(f"More than {MAX_HISTOGRAM_BUCKETS} buckets requested")
+        
+        bucket_starts = local_bucket_starts(start_ms, end_ms, bucket, tz)
+        slot_ms = histogram_slot_ms(bucket, tz, bucket_starts, end_ms)
+        if slot_ms < HOUR_MS and start_ms < retention_watermark_ms:
+            raise ValueError("Buckets under one hour are only available after the retention watermark")
+        card_ids, total = select_cards()
+    except (ValueError, ZoneInfoNotFoundError) as e:
+        logging.error(f"Invalid histogram parameters: {e}")
+        return jsonify({"error": "Invalid start, end, bucket, tz or card filter"}), 400
+    
+    try:
+        # Every local bucket of the range is returned, in order, even when empty
+        counts = run_db(fold_histogram, start_ms, end_ms, slot_ms, card_ids, bucket_starts) if card_ids else {}
+        result = [{
+            "name": datetime.fromtimestamp(bucket_ms / 1000, tz=tz).isoformat(),
+            "timestamp_ms": bucket_ms,
+            **{f"Trap {card_id}": counts[card_id][index] for card_id in card_ids},
+        } for index, bucket_ms in enumerate(bucket_starts)]
+        response = jsonify(result)
+        response.headers['X-Total-Count'] = str(total)
+        return response
+        
+    except Exception as e:
+        logging.error(f"Error getting detections histogram: {e}")
+        return jsonify({"error": "Error retrieving histogram data"}), 500
+
+
+EXPORT_COLUMNS = ['id', 'card_id', 'detection', 'timestamp_ms', 'datetime_formatted', 'created_at']
+
+def build_export_query(start_ms=None, end_ms=None, after=None, card_ids=None, limit=None):
+    """Build the keyset-paginated raw readings query ordered by (timestamp_ms, id)"""
+    query = f"SELECT {', '.join(EXPORT_COLUMNS)} FROM detections WHERE 1=1"
+    params = []
+    
+    if start_ms is not None:
+        query += " AND timestamp_ms >= ?"
+        params.append(start_ms)
+    
+    if end_ms is not None:
+        query += " AND timestamp_ms < ?"
+        params.append(end_ms)
+    
+    if after is not None:
+        # Rows strictly after the (timestamp_ms, id) cursor, written so the timestamp index is used
+        after_ts, after_id = after
+        query += " AND timestamp_ms >= ? AND (timestamp_ms > ? OR id > ?)"
+        params.extend([after_ts, after_ts, after_id])
+    
+    if card_ids is not None and len(card_ids) == 1:
+        query += " AND card_id = ?"
+        params.extend(card_ids)
+    elif card_ids is not None:
+        # Unary + keeps SQLite on the timestamp index so rows stream in order instead of
+        # being sorted in a temp B-tree, which would need memory proportional to the result
+        query += f" AND +card_id IN ({','.join('?' * len(card_ids))})"
+        params.extend(card_ids)
+    
+    query += " ORDER BY timestamp_ms, id"
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit)
+    return query, params
+
+def open_archive(path):
+    """Open a monthly archive read-only; archived files may sit on read-only storage"""
+    return sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+
+def stream_rows(query, params, archive=None):
+    """Yield batches of rows from a dedicated connection, one fetchmany round trip at a time"""
+    conn = run_db(open_archive, archive) if archive else run_db(open_connection)
+    try:
+        cursor = run_db(conn.execute, query, params)
+        while True:
+            with db_timer('export_fetch'):
+                rows = run_db(cursor.fetchmany, EXPORT_FETCH_SIZE)
+            if not rows:
+                break
+            yield rows
+    finally:
+        conn.close()
+
+def stream_partitions(query, params, start_ms=None, end_ms=None, limit=None):
+    """Stream an export query over the archives overlapping [start_ms, end_ms), then the live table.
+
+    Each month holds older readings than the next one and than the live table, so
+    concatenating the partitions keeps the (timestamp_ms, id) order.
+    """
+    sources = [path for month_start, month_end, path in archive_partitions()
+               if (start_ms is None or month_end > start_ms) and (end_ms is None or month_start < end_ms)]
+    sources.append(None)
+    remaining = limit
+    for archive in sources:
+        with closing(stream_rows(query, params, archive)) as batches:
+            for rows in batches:
+                if remaining is not None:
+                    rows = rows[:remaining]
+                    remaining -= len(rows)
+                yield rows
+                if remaining == 0:
+                    return
+
+def encode_ndjson(batches):
+    for rows in batches:
+        yield ''.join(json.dumps(dict(zip(EXPORT_COLUMNS, row))) + '\n' for row in rows).encode()
+
+def encode_csv(batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for rows in batches:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+def gzip_stream(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31: gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+@app.route('/export_detections', methods=['GET'])
+def export_detections():
+    """Stream raw readings as NDJSON (default) or CSV in (timestamp_ms, id) order.
+
+    Filters: start_date/end_date (YYYY-MM-DD, end inclusive) or start_ms/end_ms, the
+    cards/card_id/site card filters, and limit. Pass the timestamp_ms and id of the last
+    row received as after_ts and after_id to fetch the next page. gzip=1 compresses the
+    stream.
+    """
+    if storage.name != 'sqlite':
+        # Segments have no row id to order and paginate on
+        return jsonify({"error": "Export needs STORAGE_BACKEND=sqlite"}), 501
+    try:
+        start_ms = request.args.get('start_ms', type=int)
+        end_ms = request.args.get('end_ms', type=int)
+        if request.args.get('start_date'):
+            start_ms = date_to_ms(request.args['start_date'])
+        if request.args.get('end_date'):
+            end_ms = date_to_ms(request.args['end_date']) + DAY_MS
+        after = None
+        if request.args.get('after_ts') is not None:
+            after = (int(request.args['after_ts']), int(request.args.get('after_id', 0)))
+        limit = request.args.get('limit', type=int)
+        card_ids = filtered_card_ids()
+        export_format = request.args.get('format', 'ndjson')
+        if export_format not in ('ndjson', 'csv'):
+            raise ValueError(f"Unknown format {export_format}")
+    except ValueError as e:
+        logging.error(f"Invalid export parameters: {e}")
+        return jsonify({"error": "Invalid export parameters"}), 400
+    
+    query, params = build_export_query(start_ms, end_ms, after, card_ids, limit)
+    batches = stream_partitions(query, params, start_ms, end_ms, limit)
+    if export_format == 'csv':
+        body, mimetype = encode_csv(batches), 'text/csv'
+    else:
+        body, mimetype = encode_ndjson(batches), 'application/x-ndjson'
+    
+    headers = {}
+    if request.args.get('gzip') == '1':
+        body = gzip_stream(body)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(body, mimetype=mimetype, headers=headers)
+
+
+# Offline bulk import. Run it with the server stopped: during the load the detections
+# indexes are dropped and commits are not synced to disk.
+IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', 50000))
+
+def import_record(record):
+    """Map an NDJSON object or CSV row to a reading, like /send_detection does.
+
+    Accepts the /send_detection shape (x, y, detection, site) and the
+    /export_detections one (card_id, timestamp_ms, detection).
+    """
+    if not isinstance(record, dict):
+        raise ValueError("Reading must be a JSON object")
+    if 'x' not in record and 'card_id' in record:
+        record = {"x": record['card_id'], "y": record.get('timestamp_ms'),
+                  "detection": record.get('detection'), "site": record.get('site')}
+    if record.get('site') == '':
+        record = {**record, "site": None}  # empty CSV column
+    return parse_detection(record)
+
+def read_import_lines(path, offset, csv_format):
+    """Yield (record, offset after the line) from offset on; bad lines are yielded as ValueError"""
+    with open(path, 'rb') as f:
+        header = next(csv.reader([f.readline().decode()])) if csv_format else None
+        offset = max(offset, f.tell())
+        f.seek(offset)
+        for line in f:
+            offset += len(line)
+            if not line.strip():
+                continue
+            try:
+                if csv_format:
+                    record = dict(zip(header, next(csv.reader([line.decode()]))))
+                else:
+                    record = json.loads(line)
+            except ValueError as e:  # includes JSONDecodeError and UnicodeDecodeError
+                record = e
+            yield record, offset
+
+def import_pending(conn, path):
+    """True unless path was already fully imported at its current size"""
+    row = conn.execute("SELECT size, finished_at FROM import_progress WHERE path = ?", (path,)).fetchone()
+    return row is None or row[1] is None or row[0] != os.path.getsize(path)
+
+def detection_indexes_deferred(conn):
+    """True while an import has the detections indexes dropped"""
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_detections_card_ts'"
+    ).fetchone() is None
+
+def import_file(conn, path, csv_format, batch_size):
+    """Load one file from its saved offset in transactions of batch_size rows; returns (rows, rejected)"""
+    size = os.path.getsize(path)
+    row = conn.execute("SELECT size, offset, finished_at FROM import_progress WHERE path = ?", (path,)).fetchone()
+    if row is None:
+        offset = 0
+        with conn:
+            conn.execute("INSERT INTO import_progress (path, size) VALUES (?, ?)", (path, size))
+    else:
+        stored_size, offset, finished_at = row
+        if finished_at is not None and stored_size == size:
+            logging.info(f"{path} was already imported")
+            return 0, 0
+        if size < offset:
+            offset = 0  # the file was replaced: start over, duplicates are dropped at the end
+        with conn:
+            conn.execute("UPDATE import_progress SET size = ?, offset = ?, finished_at = NULL WHERE path = ?",
+                         (size, offset, path))
+        if offset:
+            logging.info(f"Resuming {path} at byte {offset} of {size}")
+    
+    imported = rejected = 0
+    batch, batch_rejected, new_cards = [], 0, []
+    # Without the unique index there is no conflict to catch: finish_import drops the duplicates
+    insert_sql = INSERT_DETECTION_SQL
+    if detection_indexes_deferred(conn):
+        insert_sql = '''
+            INSERT INTO detections (card_id, detection, timestamp_ms, datetime_formatted) VALUES (?, ?, ?, ?)
+        '''
+    
+    def flush(offset, finished=False):
+        with conn:
+            with storage.transaction():
+                if storage.name == 'sqlite':
+                    inserted = conn.executemany(insert_sql, batch).rowcount
+                else:
+                    inserted = storage.insert(conn, batch).count(True)
+            conn.executemany('''
+                INSERT INTO cards (card_id, site) VALUES (?, ?)
+                ON CONFLICT (card_id) DO UPDATE SET site = COALESCE(excluded.site, cards.site)
+            ''', [(state.card_id, state.site) for state in new_cards])
+            conn.execute('''
+                UPDATE import_progress SET offset = ?, rows = rows + ?, rejected = rejected + ?,
+                    finished_at = CASE WHEN ? THEN CURRENT_TIMESTAMP END
+                WHERE path = ?
+            ''', (offset, inserted, batch_rejected, finished, path))
+        return inserted
+    
+    start = time.perf_counter()
+    for record, offset in read_import_lines(path, offset, csv_format):
+        try:
+            if isinstance(record, Exception):
+                raise record
+            card_id, site, detection, timestamp, formatted_date = import_record(record)
+        except (ValueError, TypeError, KeyError):
+            batch_rejected += 1
+            continue
+        batch.append((card_id, detection, timestamp, formatted_date))
+        with registry_lock:
+            state, changed = _register_card_locked(card_id, site)
+        if changed:
+            new_cards.append(state)
+        if len(batch) >= batch_size:
+            imported += flush(offset)
+            rejected += batch_rejected
+            batch, batch_rejected, new_cards = [], 0, []
+            elapsed = time.perf_counter() - start
+            logging.info(f"{path}: {imported} rows ({imported / elapsed:.0f} rows/s)")
+    imported += flush(offset, finished=True)
+    rejected += batch_rejected
+    return imported, rejected
+
+def finish_import(conn):
+    """Rebuild what the load skipped: drop duplicates, recreate the indexes, rollups and latest state.
+
+    Returns the number of duplicate readings removed.
+    """
+    with conn:
+        removed = 0
+        if detection_indexes_deferred(conn):
+            logging.info("Building the detections indexes")
+            # Keep the first stored copy of each reading, like the unique index would have
+            removed = conn.execute('''
+                DELETE FROM detections WHERE id NOT IN (
+                    SELECT MIN(id) FROM detections GROUP BY card_id, timestamp_ms
+                )
+            ''').rowcount
+            conn.execute("CREATE UNIQUE INDEX idx_detections_card_ts ON detections (card_id, timestamp_ms)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_detections_ts ON detections (timestamp_ms)")
+        rebuild_rollups_since(conn, load_retention_watermark(conn))
+        rebuild_latest_state(conn)
+    return removed
+
+@app.cli.command('import-detections')
+@click.argument('files', nargs=-1, type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'file_format', type=click.Choice(['auto', 'ndjson', 'csv']), default='auto',
+              help='File format; auto picks csv for .csv files and ndjson otherwise.')
+@click.option('--batch-size', type=int, default=IMPORT_BATCH_SIZE, help='Rows per transaction.')
+@click.option('--keep-indexes', is_flag=True, help='Keep the indexes during the load (small imports).')
+def import_detections_command(files, file_format, batch_size, keep_indexes):
+    """Load NDJSON or CSV readings into the database, with the server stopped.
+
+    An interrupted import resumes where it stopped when run again with the same files.
+    Without FILES, finishes an interrupted import.
+    """
+    stop_compaction()
+    conn = open_connection()
+    # Relaxed durability for the load: a crash loses at most the uncommitted batch, which
+    # the saved offset replays. The final checkpoint below syncs everything.
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-262144")  # 256 MiB for the index builds
+    try:
+        paths = [os.path.abspath(path) for path in files]
+        # Files already imported are skipped: with nothing pending and no interrupted import to
+        # finish, the indexes, rollups and latest state are left alone
+        pending = any(import_pending(conn, path) for path in paths)
+        interrupted = detection_indexes_deferred(conn)
+        if pending and not keep_indexes and storage.name == 'sqlite':
+            with conn:
+                conn.execute("DROP INDEX IF EXISTS idx_detections_card_ts")
+                conn.execute("DROP INDEX IF EXISTS idx_detections_ts")
+        
+        start = time.perf_counter()
+        total = 0
+        for path in paths:
+            csv_format = file_format == 'csv' or (file_format == 'auto' and path.lower().endswith('.csv'))
+            imported, rejected = import_file(conn, path, csv_format, batch_size)
+            total += imported
+            print(f"{path}: {imported} rows, {rejected} rejected")
+        load_seconds = time.perf_counter() - start
+        
+        removed = finish_import(conn) if pending or interrupted else 0
+        conn.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        conn.close()
+    
+    elapsed = time.perf_counter() - start
+    print(f"Imported {total - removed} rows in {elapsed:.1f}s ({total / max(load_seconds, 1e-9):.0f} rows/s load, "
+          f"{(total - removed) / max(elapsed, 1e-9):.0f} rows/s overall), {removed} duplicates removed")
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    if MESSAGE_QUEUE:
+        sync_shared_state()
+
+@app.after_request
+def record_request_latency(response):
+    # Streaming responses (exports) are measured up to the first byte
+    start = g.pop('request_start', None)
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUEST_LATENCY.observe((route, request.method, response.status_code), time.perf_counter() - start)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Expose request, SQLite, ingest queue and Socket.IO metrics in Prometheus text format"""
+    lines = []
+    for metric in (REQUEST_LATENCY, DB_LATENCY, INGESTED_READINGS, SOCKETIO_EMITS, SOCKETIO_DELTAS,
+                   SOCKETIO_RESUMES, COMPACTED_READINGS, RESPONSE_CACHE_REQUESTS):
+        lines.extend(metric.render())
+    lines += [
+        "# HELP ingest_queue_depth Readings waiting in the write-behind queue",
+        "# TYPE ingest_queue_depth gauge",
+        f"ingest_queue_depth {ingest_queue.qsize()}",
+        "# HELP ingest_queue_capacity Size of the write-behind queue",
+        "# TYPE ingest_queue_capacity gauge",
+        f"ingest_queue_capacity {WRITE_BEHIND_QUEUE_SIZE if WRITE_BEHIND else 0}",
+        "# HELP registered_cards Cards in the card registry",
+        "# TYPE registered_cards gauge",
+        f"registered_cards {len(card_registry)}",
+    ]
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+
+# Create the schema and load the latest state once per process
+init_database()
+with db_connection() as _conn:
+    load_retention_watermark(_conn)
+hydrate_latest_cache()
+
+if WRITE_BEHIND and not IS_LAUNCHER:
+    start_write_behind()
+
+# One compaction thread per deployment: the single server or the first worker
+if RETENTION_DAYS > 0 and not IS_LAUNCHER and WORKER_INDEX in (None, '0'):
+    start_compaction()
+
 
 @socketio.on('connect')
 def handle_connect():
+    # New clients get every delta until they subscribe to specific cards or sites;
+    # the current state comes from the 'subscribe' or 'resume' ack, or /get_detection
     logging.info("Client connected")
-    emit('update_detection', detection_data)
+    join_room('all')
+
+def parse_room_request(data):
+    """Return (card_ids, sites) from a {"cards": [1, "2"], "sites": ["north"]} payload.
+
+    Raises ValueError unless data is an object whose cards are a list of integers or
+    numeric strings and whose sites are a list of strings.
+    """
+    data = data or {}
+    if not isinstance(data, dict):
+        raise ValueError("Payload must be an object")
+    cards = data.get('cards') or []
+    sites = data.get('sites') or []
+    if not isinstance(cards, list) or not isinstance(sites, list):
+        raise ValueError("cards and sites must be lists")
+    # bool is an int subclass, and int() would truncate floats
+    if any(isinstance(card_id, bool) or not isinstance(card_id, (int, str)) for card_id in cards):
+        raise ValueError("cards must be integers")
+    if not all(isinstance(site, str) for site in sites):
+        raise ValueError("sites must be strings")
+    return sorted({int(card_id) for card_id in cards}), sites
+
+@socketio.on('subscribe')
+def handle_subscribe(data):
+    """Switch to per-card and per-site rooms: {"cards": [1, 2], "sites": ["north"]}"""
+    try:
+        card_ids, sites = parse_room_request(data)
+    except ValueError:
+        return {"error": "Invalid subscription"}
+    
+    if card_ids or sites:
+        leave_room('all')
+    else:
+        join_room('all')
+    for card_id in card_ids:
+        join_room(f"card:{card_id}")
+    for site in sites:
+        join_room(f"site:{site}")
+    
+    # Ack with the current state of the subscribed cards
+    if MESSAGE_QUEUE:
+        sync_shared_state()
+    with registry_lock:
+        site_ids = [card_id for site in sites for card_id in site_card_ids.get(site, [])]
+    return {"stream": DELTA_STREAM_ID, "seq": newest_delta_seq(), "cards": card_snapshot(sorted(set(card_ids) | set(site_ids)))}
+
+@socketio.on('unsubscribe')
+def handle_unsubscribe(data):
+    """Leave per-card and per-site rooms: {"cards": [1], "sites": ["north"]}"""
+    try:
+        card_ids, sites = parse_room_request(data)
+    except ValueError:
+        return {"error": "Invalid subscription"}
+    for card_id in card_ids:
+        leave_room(f"card:{card_id}")
+    for site in sites:
+        leave_room(f"site:{site}")
+    return {"ok": True}
+
+@socketio.on('resume')
+def handle_resume(data):
+    """Replay the deltas missed since {"last_seq": 41, "stream": "..."}, or send a snapshot.
+
+    The ack is {"stream", "seq", "deltas"} when every missed delta is still buffered,
+    otherwise {"stream", "seq", "snapshot"} with the current state of the client's cards.
+    Only deltas for the rooms the client is in are returned.
+    """
+    data = data or {}
+    if not isinstance(data, dict):
+        return {"error": "Invalid resume request"}
+    try:
+        last_seq = int(data['last_seq']) if data.get('last_seq') is not None else None
+    except (TypeError, ValueError):
+        return {"error": "Invalid last_seq"}
+    
+    # Picks up an /empty_database run by another worker, which clears the buffer
+    if MESSAGE_QUEUE:
+        sync_shared_state()
+    joined = set(rooms())
+    deltas, newest = None, None
+    if last_seq is not None and data.get('stream') == DELTA_STREAM_ID:
+        deltas, newest = deltas_since(last_seq)
+    if deltas is not None:
+        SOCKETIO_RESUMES.inc(('replay',))
+        if 'all' not in joined:
+            deltas = [delta for delta in deltas
+                      if f"card:{delta['card_id']}" in joined or f"site:{delta['site']}" in joined]
+        return {"stream": DELTA_STREAM_ID, "seq": newest, "deltas": deltas}
+    
+    # Gap larger than the buffer, or a different server process: send the current state
+    SOCKETIO_RESUMES.inc(('snapshot',))
+    newest = newest_delta_seq()
+    with registry_lock:
+        if 'all' in joined:
+            card_ids = list(sorted_card_ids)
+        else:
+            card_ids = {int(room[5:]) for room in joined if room.startswith('card:')}
+            for room in joined:
+                if room.startswith('site:'):
+                    card_ids.update(site_card_ids.get(room[5:], []))
+            card_ids = sorted(card_ids)
+    return {"stream": DELTA_STREAM_ID, "seq": newest, "snapshot": card_snapshot(card_ids)}
 
 @socketio.on('disconnect')
 def handle_disconnect():
     logging.info("Client disconnected")
 
-if __name__ == '__main__':
+def run_workers():
+    """Start WORKERS server processes on consecutive ports and wait for them"""
+    port = int(os.environ.get('PORT', 5000))
+    workers = []
+    for index in range(WORKERS):
+        env = dict(os.environ, WORKER_INDEX=str(index), PORT=str(port + index), MESSAGE_QUEUE=MESSAGE_QUEUE)
+        workers.append(subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env))
+    logging.info(f"Started {WORKERS} workers on ports {port}-{port + WORKERS - 1} (message queue: {MESSAGE_QUEUE})")
+    # docker stop sends SIGTERM: turn it into SystemExit so the workers are stopped too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for worker in workers:
+            worker.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            if worker.poll() is None:
+                worker.terminate()
+        for worker in workers:
+            worker.wait()
+
+if __name__ == '__main__' and IS_LAUNCHER:
+    run_workers()
+elif __name__ == '__main__':
+    with db_connection() as _conn:
+        if detection_indexes_deferred(_conn):
+            raise RuntimeError("A bulk import was interrupted: run 'flask import-detections' to resume or finish it")
+    
     # Initialize database on startup
     print("=" * 50)
     print("STARTING APPLICATION")
@@ -522,34 +2897,13 @@ if __name__ == '__main__':
     print(f"Database path: {DB_NAME}")
     print("=" * 50)
     
-    # Check if database exists BEFORE init
-    if os.path.exists(DB_NAME):
-        file_size = os.path.getsize(DB_NAME)
-        mod_time = os.path.getmtime(DB_NAME)
-        print(f"Existing database found - Size: {file_size} bytes, Modified: {mod_time}")
-    else:
-        print("No existing database found")
-    
-    init_database()
-    logging.info("Database initialized")
-    
-    # Double-check database has data if any
-    try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM detections")
-        startup_count = cursor.fetchone()[0]
-        logging.info(f"Application startup - Total records: {startup_count}")
-        
-        if startup_count > 0:
-            cursor.execute("SELECT * FROM detections ORDER BY created_at DESC LIMIT 3")
-            recent_data = cursor.fetchall()
-            logging.info(f"Most recent records: {recent_data}")
-        
-        conn.close()
-    except Exception as e:
-        logging.error(f"Startup database check error: {e}")
+    # docker stop and the launcher send SIGTERM, which skips atexit: exit normally instead,
+    # so the write-behind queue is flushed and the compaction thread stops cleanly
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     
-    print("Starting Flask server...")
+    print(f"Starting Flask server ({ASYNC_MODE} mode)...")
+    # Debug (and the Werkzeug dev server) only for the threading mode unless overridden
+    debug = os.environ.get('FLASK_DEBUG', '1' if ASYNC_MODE == 'threading' else '0') == '1'
     # DISABLE auto-reloader to prevent multiple process issues
-    socketio.run(app, host='0.0.0.0', port=5000, debug=True, use_reloader=False)
\ No newline at end of file
+    socketio.run(app, host=os.environ.get('HOST', '0.0.0.0'), port=int(os.environ.get('PORT', 5000)),
+                 debug=debug, use_reloader=False, allow_unsafe_werkzeug=True)
\ No newline at end of file